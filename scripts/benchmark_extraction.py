@@ -0,0 +1,52 @@
+import os.path
+import timeit
+
+from lxml import etree
+
+from eth_loader.extraction import extract_page, extract_page_tree
+
+"""
+Benchmark of the site extraction used by the indexer on the sample sites.
+
+- baseline: etree.HTML on the decoded string with ad-hoc xpath calls (what __sub_index used to do)
+- tree: extract_page_tree, reused parser and pre-compiled XPath
+- fast path: extract_page, byte scan without building a tree
+
+Run from the repository root with src on the python path:
+PYTHONPATH=src python scripts/benchmark_extraction.py
+"""
+
+samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample text")
+files = ["with_player.html", "without_player.html"]
+number = 200
+
+
+def baseline(content: bytes):
+    tree = etree.HTML(content.decode("utf-8"))
+    x = tree.xpath("//div[@class='newsListBox']/a")
+
+    if len(tree.xpath("//vp-episode-page")) > 0:
+        return True, []
+
+    return False, [a.attrib["href"] for a in x if "href" in a.keys()]
+
+
+for file in files:
+    with open(os.path.join(samples, file), "rb") as f:
+        content = f.read()
+
+    # all variants need to agree before comparing their speed
+    expected = baseline(content)
+    assert extract_page_tree(content) == expected, file
+    assert extract_page(content) == expected, file
+
+    print(f"{file} ({len(content)} bytes, video: {expected[0]}, links: {len(expected[1])})")
+
+    reference = None
+    for name, fn in [("baseline", baseline), ("tree", extract_page_tree), ("fast path", extract_page)]:
+        seconds = timeit.timeit(lambda: fn(content), number=number) / number
+
+        if reference is None:
+            reference = seconds
+
+        print(f"    {name:<10} {seconds * 1e6:10.1f} us/page  {reference / seconds:6.1f}x")
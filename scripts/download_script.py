@@ -1,7 +1,9 @@
 import os.path
-import requests as rq
+from eth_loader.rate_limit import HostRateLimiter
+from eth_loader.transport import configure
 
-session = rq.session()
+# all requests, including the video downloads, go through the rate limited transport of eth_loader.
+session = configure(rate_limiter=HostRateLimiter(requests_per_second=5.0, burst=10.0))
 
 """
 Script handles the downloading and only the downloading of the files. 
@@ -16,11 +18,8 @@ The script is single threaded and not optimized in any way shape or form.
 def target_loader(url: str, path: str):
     print(f"downloading {url}\n"
           f"to {path}")
-    stream = rq.get(maxq_url["url"], headers={"user-agent": "Firefox"})
+    stream = session.download(maxq_url["url"], path, headers={"user-agent": "Firefox"})
     if stream.ok:
-        with open(path, "wb") as file:
-            file.write(stream.content)
-
         print(f"Done {os.path.join(folder, f'{date}.mp4')}")
 
 
@@ -99,11 +98,9 @@ for u in urls:
                 print(f"downloading {maxq_url['url']}\n"
                       f"to {os.path.join(folder, f'{date}.mp')}")
 
-                stream = rq.get(maxq_url["url"], headers={"user-agent": "Firefox"})
+                stream = session.download(maxq_url["url"], os.path.join(folder, f"{date}.mp4"),
+                                          headers={"user-agent": "Firefox"})
                 if stream.ok:
-                    with open(os.path.join(folder, f"{date}.mp4"), "wb") as file:
-                        file.write(stream.content)
-
                     print(f"Done {os.path.join(folder, f'{date}.mp4')}")
 
         else:
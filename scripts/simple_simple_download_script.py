@@ -1,6 +1,5 @@
 import os.path
 import subprocess
-import requests as rq
 from dataclasses import dataclass
 from concurrent.futures import ThreadPoolExecutor
 import multiprocessing as mp
@@ -8,9 +7,12 @@ import threading as th
 import queue
 import time
 from secrets import username, password, arguments, download_directory, SeriesArgs
+from eth_loader.rate_limit import HostRateLimiter
+from eth_loader.transport import configure
 
 
-session = rq.session()
+# all requests, including the video downloads, go through the rate limited transport of eth_loader.
+session = configure(rate_limiter=HostRateLimiter(requests_per_second=5.0, burst=10.0))
 
 
 @dataclass()
@@ -27,11 +29,8 @@ def target_loader(command: dict):
     path = command["path"]
     print(f"downloading {url}\n"
           f"to {path}")
-    stream = rq.get(url, headers={"user-agent": "Firefox"})
+    stream = session.download(url, path, headers={"user-agent": "Firefox"})
     if stream.ok:
-        with open(path, "wb") as f:
-            f.write(stream.content)
-
         print(f"Done {os.path.join(folder, f'{date}.mp4')}")
         return "success"
 
@@ -57,7 +56,7 @@ if login.status_code == 403:
 for argu in arguments:
     if argu.username is not None and argu.password is not None:
         strip_url = argu.url.replace("www.", "").replace(".html", "").replace(".series-metadata.json", "")
-        login = rq.post(url=f"{strip_url}.series-login.json",
+        login = session.post(url=f"{strip_url}.series-login.json",
                         headers={"user-agent": "lol herre"},
                         data={"_charset_": "utf-8", "username": argu.username, "password": argu.password})
 
@@ -0,0 +1,71 @@
+import threading
+
+"""
+# Byte accounting
+
+Every response fetched through the Transport is counted for the stage that fetched it:
+
+- wire bytes: bytes received from the connection, compressed if the server used a content encoding
+- decoded bytes: bytes of the body after decompression
+
+The ratio of the two is the saving of the compressed transfer. Responses above the heavy threshold are reported when
+they arrive, so unexpectedly large pages stand out.
+"""
+
+
+class ByteCounters:
+    """
+    Thread safe wire and decoded byte counters per stage.
+    """
+
+    def __init__(self, heavy_threshold: int = 512 * 1024):
+        """
+        :param heavy_threshold: decoded bytes above which a response is reported, None to not report any
+        """
+        self.heavy_threshold = heavy_threshold
+
+        self.__counters = {}
+        self.__lock = threading.Lock()
+
+    def add(self, stage: str, url: str, wire: int, decoded: int):
+        """
+        Counts a response.
+
+        :param stage: stage that fetched the response like 'index', 'metadata' or 'streams'
+        :param url: url of the response
+        :param wire: bytes received from the connection
+        :param decoded: bytes of the decoded body
+        :return:
+        """
+        with self.__lock:
+            counter = self.__counters.setdefault(stage, {"responses": 0, "wire": 0, "decoded": 0})
+            counter["responses"] += 1
+            counter["wire"] += wire
+            counter["decoded"] += decoded
+
+        if self.heavy_threshold is not None and decoded > self.heavy_threshold:
+            # TODO: logging and debug shit
+            print(f"Heavy response {url}: {decoded} bytes decoded, {wire} bytes on the wire")
+
+    def get(self, stage: str) -> dict:
+        """
+        Counters of a stage.
+
+        :param stage: name of the stage
+        :return: dict with responses, wire and decoded
+        """
+        with self.__lock:
+            return dict(self.__counters.get(stage, {"responses": 0, "wire": 0, "decoded": 0}))
+
+    def report(self, stage: str) -> str:
+        """
+        Human readable summary of the counters of a stage.
+
+        :param stage: name of the stage
+        :return:
+        """
+        counter = self.get(stage)
+        ratio = counter["decoded"] / counter["wire"] if counter["wire"] > 0 else 1.0
+
+        return f"{stage}: {counter['responses']} responses, {counter['wire'] / 1e6:.1f} MB on the wire, " \
+               f"{counter['decoded'] / 1e6:.1f} MB decoded ({ratio:.1f}x)"
@@ -0,0 +1,323 @@
+import asyncio
+import traceback
+from time import monotonic
+
+import aiohttp
+from lxml import etree
+from lxml.etree import _Element
+
+from eth_loader.frontier import VisitedSet
+from eth_loader.extraction import extract_page
+from eth_loader.indexer import ConcurrentETHSiteIndexer
+from eth_loader.retry import CLOSED, RetryPolicy
+from eth_loader.transport import ACCEPT_ENCODING, get_transport
+
+"""
+# Functionality of Class:
+
+Asyncio based alternative to the thread based ConcurrentETHSiteIndexer. It writes the same 'sites' table, but all
+requests are performed from a single event loop instead of one OS thread per worker.
+
+## Life cycle of AsyncETHSiteIndexer
+- init: same as ConcurrentETHSiteIndexer, additionally stores the concurrency limit
+- index_video_eth: runs the crawl on a fresh event loop and writes the last batch of results
+- __crawl: opens the aiohttp session, schedules the links of the root site ('__seed') or the unfinished sites of the
+    previous run ('resume_targets') and waits until the frontier is empty
+- gen_parent: inherited, create the linking to create the site hierarchy in the database.
+
+## Coroutine life cycle
+- __worker: takes targets from the frontier queue and calls '__sub_index' for them, until it is cancelled. Targets
+    that raise are logged and flagged as failed.
+- __fetch: requests a page, retries connection errors, timeouts and retryable statuses with the backoff of the
+    RetryPolicy. Shares the rate limiter and circuit breakers of the transport with the threaded stages.
+- __sub_index: fetches page, stores result in the batch ('store'), if the page is not a video, schedules all children on the frontier
+    Sites known from a previous run are revalidated like in ConcurrentETHSiteIndexer. With parse_processes the
+    parsing runs in the parser processes instead of blocking the event loop.
+"""
+
+
+class AsyncETHSiteIndexer(ConcurrentETHSiteIndexer):
+    """
+    Creates a Database of the hierarchy of the video sites of video.ethz.ch, using asyncio instead of threads.
+    """
+
+    def __init__(self, file: str, prefixes: list = None, concurrency: int = 1000, bloom_capacity: int = None,
+                 parse_processes: int = None):
+        """
+        Initializer for asynchronous indexing of entire video.ethz.ch site.
+
+        :param file: output where the video-series urls are stored.
+        :param prefixes: provide custom prefixes, main_header [campus, lectures, ...]
+        :param concurrency: maximum number of requests in flight at the same time 1-100'000
+        :param bloom_capacity: back the visited set by a bloom filter of this capacity to bound memory on huge crawls
+        :param parse_processes: parse the sites in a pool of this many processes, None to parse on the event loop
+        """
+        super().__init__(file, prefixes, bloom_capacity, parse_processes)
+
+        if not 1 <= concurrency <= 100000:
+            raise ValueError("Concurrency outside supported range [1:100'000]")
+
+        self.concurrency = concurrency
+        self.headers = {"user-agent": "Mozilla Firefox", "accept-encoding": ACCEPT_ENCODING}
+        self.frontier: asyncio.Queue = None
+        self.batch = []
+        self.last_commit = 0.0
+        self.batch_size = 500
+        self.commit_interval = 2.0
+        self.retry_policy = RetryPolicy()
+
+    def index_video_eth(self, resume: bool = False):
+        """
+        Starts the indexing of the site.
+
+        :param resume: continue the previous run (only the sites it didn't finish), starts a full run if there is none
+        :return:
+        """
+        sites_before = self.db.count_sites()
+
+        self.start_parse_pool()
+        try:
+            asyncio.run(self.__crawl(resume))
+        finally:
+            self.stop_parse_pool()
+
+        self.write_batch(self.batch)
+        self.batch = []
+
+        # TODO: logger and debug shit
+        print(f"Inserted {self.db.count_sites() - sites_before} entries in sites table")
+        print(get_transport().bytes.report("index"))
+
+    async def __crawl(self, resume: bool):
+        """
+        Loads the root site, schedules all valid links for the workers and waits for the frontier to be empty.
+
+        :param resume: schedule the unfinished sites of the previous run instead of the links of the root site
+        :return:
+        """
+        self.frontier = asyncio.Queue()
+        self.batch = []
+        self.last_commit = monotonic()
+        self.load_known_sites()
+        self.visited = VisitedSet(self.bloom_capacity)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        # same deadlines as the threaded stages
+        connect_timeout, read_timeout = get_transport().timeout
+        timeout = aiohttp.ClientTimeout(total=get_transport().deadline, sock_connect=connect_timeout,
+                                        sock_read=read_timeout)
+
+        async with aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=timeout) as session:
+            if not (resume and self.resume_targets()):
+                await self.__seed(session)
+
+            workers = [asyncio.create_task(self.__worker(session)) for _ in range(self.concurrency)]
+            print("Workers Spawned")
+
+            # every target calls task_done after its children are scheduled, so join returns once the crawl is done.
+            await self.frontier.join()
+
+            for worker in workers:
+                worker.cancel()
+
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def __seed(self, session: aiohttp.ClientSession):
+        """
+        Starts a new full run, schedules all valid links of the root site.
+
+        :param session: aiohttp session shared by all workers
+        :return:
+        """
+        self.work_state.reset()
+
+        # load main site
+        async with session.get("https://www.video.ethz.ch/") as resp:
+            html = (await resp.read()).decode("utf-8")
+
+        tree = etree.HTML(html)
+        uris = []
+
+        # find all <a> elements
+        for a in tree.xpath("//a"):
+            a: _Element
+
+            # Verify that href is a key
+            if "href" in a.keys():
+                uri = a.attrib["href"]
+
+                if self.val_uri(uri) and uri not in uris:
+                    uris.append(uri)
+                    print(f"uri {uri}")
+                    self.sub_index(f"https://www.video.ethz.ch{uri}", uri)
+
+        self.work_state.add_pending([(f"https://www.video.ethz.ch{uri}", uri) for uri in uris])
+        self.db.commit()
+
+    async def __worker(self, session: aiohttp.ClientSession):
+        """
+        Coroutine taking targets from the frontier until it is cancelled.
+
+        :param session: aiohttp session shared by all workers
+        :return:
+        """
+        while True:
+            target = await self.frontier.get()
+            try:
+                await self.__sub_index(session, target["url"], target["prefix"])
+            except Exception:
+                # a failed target must not end the worker, the frontier would never be joined.
+                # TODO: logger and debug shit
+                print(traceback.format_exc())
+                print(target)
+                self.store({"url": target["url"], "failed": True})
+            finally:
+                self.frontier.task_done()
+
+    async def __fetch(self, session: aiohttp.ClientSession, url: str) -> tuple:
+        """
+        Requests the site, retrying connection errors, timeouts and retryable statuses, other errors are raised right
+        away. Every attempt waits for the circuit breaker and takes a token of the rate limiter of the shared
+        transport, like the threaded stages.
+
+        :param session: aiohttp session shared by all workers
+        :param url: url of the site
+        :return: tuple (status, etag, last_modified, content) of the last attempt
+        """
+        transport = get_transport()
+        breaker = transport.circuit_breakers.get(url)
+        attempt = 0
+
+        while True:
+            # waiting for the breaker blocks, only hand it to a thread while the breaker isn't closed
+            if breaker.state != CLOSED:
+                await asyncio.get_running_loop().run_in_executor(None, breaker.wait)
+
+            if transport.rate_limiter is not None:
+                await asyncio.sleep(transport.rate_limiter.reserve_request(url))
+
+            try:
+                async with session.get(url, headers=self.conditional_headers(url)) as resp:
+                    status = resp.status
+                    etag = resp.headers.get("ETag")
+                    last_modified = resp.headers.get("Last-Modified")
+                    retry_after = resp.headers.get("Retry-After")
+                    content = await resp.read()
+
+                    # aiohttp only exposes the decoded body, the Content-Length is the size on the wire if present
+                    wire = resp.content_length or len(content)
+                    transport.bytes.add("index", url, wire, len(content))
+
+                if transport.rate_limiter is not None:
+                    await asyncio.sleep(transport.rate_limiter.reserve_bytes(url, wire))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+
+                if attempt + 1 >= self.retry_policy.max_attempts:
+                    raise
+
+                delay = self.retry_policy.delay(attempt)
+                reason = repr(e)
+            except Exception:
+                # can't succeed on a retry (invalid url, decoding, ...), the host wasn't the problem
+                breaker.record_success()
+                raise
+            else:
+                if self.retry_policy.is_retryable_status(status):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+
+                if not self.retry_policy.is_retryable_status(status) or attempt + 1 >= self.retry_policy.max_attempts:
+                    return status, etag, last_modified, content
+
+                delay = self.retry_policy.delay(attempt, retry_after)
+                reason = f"status {status}"
+
+            # TODO: logger and debug shit
+            print(f"Retrying {url} in {delay:.1f}s after {reason}")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def __sub_index(self, session: aiohttp.ClientSession, url: str, prefix: str):
+        """
+        Loads sub site and then proceeds to search it for either a video or a list of sub sites.
+        Sub sites are put on the frontier, the site itself is written to the database.
+
+        :param session: aiohttp session shared by all workers
+        :param url: full url of sub site to index like https://www.video.ethz.ch/speakers/d-infk/2015.html
+        :param prefix: prefix of the site, only searching urls with identical prefix, like /speakers/d-infk
+        :return:
+        """
+        # load target site
+        status, etag, last_modified, content = await self.__fetch(session, url)
+
+        # site unchanged since the last run, only mark it as seen and revisit the children known from the last run.
+        if status == 304:
+            known = self.known_sites[url]
+            children = [] if known["is_video"] else self.known_child_targets(url, prefix)
+
+            self.store({"url": url, "is_video": known["is_video"], "not_modified": True, "children": children})
+
+            for child, uri in children:
+                self.sub_index(child, uri)
+            return
+
+        # failed for good, the site stays unfinished in the work state and is retried by a resumed run. It's flagged
+        # in the sites table, so the next run loads it again when its parent is unchanged.
+        if status >= 400:
+            # TODO: logger and debug shit
+            print(f"Failed {url} with status {status}")
+            self.store({"url": url, "failed": True})
+            return
+
+        # check for the video player and get the links of the box where the list of 'child organizers' are stored
+        if self.parse_pool is None:
+            a_video, hrefs = extract_page(content)
+        else:
+            a_video, hrefs = await asyncio.get_running_loop().run_in_executor(self.parse_pool, extract_page, content)
+
+        children = []
+        if not a_video:
+            for uri in hrefs:
+                # verify it is on the same branch but not the same uri
+                if (prefix.split(".")[0] in uri) and (prefix != uri):
+                    children.append((f"https://www.video.ethz.ch{uri}", uri))
+
+        self.store({"url": url, "is_video": int(a_video), "etag": etag, "last_modified": last_modified,
+                    "children": children})
+
+        for child, uri in children:
+            self.sub_index(child, uri)
+
+        # TODO: logger and debug shit
+        print(f"Done {url}")
+
+    def store(self, result: dict):
+        """
+        Adds a result to the batch, writes the batch once it is full or the commit interval passed.
+        The event loop is the only writer, so the db can be accessed directly.
+
+        :param result: result dict like ConcurrentETHSiteIndexer puts in the found_url_queue
+        :return:
+        """
+        self.batch.append(result)
+
+        if len(self.batch) >= self.batch_size or monotonic() - self.last_commit >= self.commit_interval:
+            self.write_batch(self.batch)
+            self.batch = []
+            self.last_commit = monotonic()
+
+    def sub_index(self, url: str, prefix: str):
+        """
+        Puts the target on the frontier, unless it was already scheduled in this run.
+
+        :param url: full url of sub site to index like https://www.video.ethz.ch/speakers/d-infk/2015.html
+        :param prefix: prefix of the site, only searching urls with identical prefix, like /speakers/d-infk
+        :return:
+        """
+        if not self.visited.add_if_new(url):
+            return
+
+        self.frontier.put_nowait({"url": url, "prefix": prefix})
@@ -0,0 +1,140 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Tuple
+
+from requests.cookies import RequestsCookieJar
+
+"""
+# Series login cache
+
+Password protected series need a login at <series>.series-login.json, the returned cookies grant access to all of
+its episodes. The LoginCache logs in once per stripped series (or episode) url and hands out the cookie jar until it
+expires:
+
+- login_all: logs in to all given series concurrently, before the first episode is enqueued. Series whose login
+    failed fall back to the general login until the failure expires (max_age).
+- cookies: cookie jar for an episode, logs in if the cached jar is missing or expired
+- invalidate: drops jars the server rejected (401 / 403), the next call of cookies logs in again. Jars obtained after
+    the rejected request was sent are kept, so concurrent workers hitting the same expired login only log in once.
+"""
+
+
+class LoginCache:
+    """
+    Thread safe cache of the cookie jars of the series specific logins, keyed by the stripped url.
+    """
+
+    def __init__(self, credentials: Dict[str, Tuple[str, str]], login: Callable, default=None,
+                 max_age: float = 1800.0):
+        """
+        :param credentials: stripped url: (username, password)
+        :param login: function(stripped url, username, password) returning the cookie jar or None if it failed
+        :param default: cookie jar used without a specific login (and if it failed)
+        :param max_age: seconds a jar is used if none of its cookies has an expiry date
+        """
+        self.credentials = credentials
+        self.login = login
+        self.default = default
+        self.max_age = max_age
+
+        # stripped url: (cookie jar, obtained, expires)
+        self.__jars = {}
+        self.__lock = threading.Lock()
+        self.__key_locks = {}
+
+    def keys(self, *urls: str) -> Tuple[str, ...]:
+        """
+        The stripped urls among the given ones which need a specific login.
+        """
+        return tuple(url for url in urls if url in self.credentials)
+
+    def __key_lock(self, key: str) -> threading.Lock:
+        with self.__lock:
+            return self.__key_locks.setdefault(key, threading.Lock())
+
+    def __expires(self, jar) -> float:
+        now = time.time()
+        expires = [cookie.expires for cookie in jar if cookie.expires is not None] if jar is not None else []
+        return min(expires + [now + self.max_age])
+
+    def __jar(self, key: str):
+        """
+        Cookie jar of a single login, logs in if there is no valid one.
+        """
+        # one login per key at a time, the others wait for its result
+        with self.__key_lock(key):
+            entry = self.__jars.get(key)
+
+            if entry is not None and entry[2] > time.time():
+                return entry[0]
+
+            username, password = self.credentials[key]
+            obtained = time.time()
+
+            # an unreachable series must not abort the others, it's treated like a rejected login
+            try:
+                jar = self.login(key, username, password)
+            except Exception as e:
+                # TODO: logging and debug shit
+                print(f"Login for {key} raised {e!r}")
+                jar = None
+
+            if jar is None:
+                # TODO: logging and debug shit
+                print(f"Login failed for {key}, falling back to the general login")
+
+            self.__jars[key] = (jar, obtained, self.__expires(jar))
+            return jar
+
+    def login_all(self, keys: Iterable[str], workers: int = 8):
+        """
+        Logs in to all given stripped urls concurrently. A failed login (or one that raised) only affects its own
+        key, the episodes of that key use the general login.
+
+        :param keys: stripped urls, duplicates are logged in once
+        :param workers: maximum number of concurrent logins
+        :return:
+        """
+        keys = set(keys)
+        if len(keys) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(keys))) as pool:
+            list(pool.map(self.__jar, keys))
+
+    def cookies(self, keys: Tuple[str, ...]):
+        """
+        Cookie jar with the logins of all given stripped urls.
+
+        :param keys: stripped urls as returned by keys
+        :return: cookie jar, the default jar if keys is empty
+        """
+        jars = [jar for jar in (self.__jar(key) for key in keys) if jar is not None]
+
+        if len(jars) == 0:
+            return self.default
+
+        if len(jars) == 1:
+            return jars[0]
+
+        merged = RequestsCookieJar()
+        for jar in jars:
+            merged.update(jar)
+
+        return merged
+
+    def invalidate(self, keys: Tuple[str, ...], since: float):
+        """
+        Drops the jars of the given stripped urls that were obtained before since.
+
+        :param keys: stripped urls whose login was rejected
+        :param since: time.time() at which the rejected request was sent
+        :return:
+        """
+        with self.__lock:
+            for key in keys:
+                entry = self.__jars.get(key)
+
+                if entry is not None and entry[1] <= since:
+                    del self.__jars[key]
@@ -0,0 +1,110 @@
+import datetime
+from sqlite3 import Connection
+
+"""
+# Checkpoints of the pipeline stages
+
+The work of every stage is recorded in the 'work_state' table of the stage's database, one row per url and stage:
+
+- pending: the url is known but wasn't handed to a worker yet
+- in_flight: the url was handed to a worker in the current run
+- done: the result of the url is written to the database
+
+The rows are written by the thread writing the results, in the same transaction as the results, so the state and the
+results can't diverge. After a crash, a run with resume=True only enqueues the urls that are not done.
+"""
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+
+
+class WorkState:
+    """
+    Work state of a single stage inside the work_state table.
+    """
+
+    def __init__(self, con: Connection, stage: str):
+        """
+        :param con: connection to the database of the stage. Only use the WorkState from the thread owning it.
+        :param stage: name of the stage like 'index', 'metadata' or 'streams'
+        """
+        self.con = con
+        self.cur = con.cursor()
+        self.stage = stage
+
+        self.cur.execute("CREATE TABLE IF NOT EXISTS work_state "
+                         "(stage TEXT, "
+                         "URL TEXT, "
+                         "state TEXT CHECK (state IN ('pending', 'in_flight', 'done')), "
+                         "payload TEXT, "
+                         "updated TEXT, "
+                         "PRIMARY KEY (stage, URL))")
+
+    def has_run(self) -> bool:
+        """
+        Checks if a previous run of the stage recorded any work.
+        :return:
+        """
+        self.cur.execute("SELECT 1 FROM work_state WHERE stage = ? LIMIT 1", (self.stage,))
+        return self.cur.fetchone() is not None
+
+    def reset(self):
+        """
+        Removes the work state of the stage, so a new full run starts.
+        :return:
+        """
+        self.cur.execute("DELETE FROM work_state WHERE stage = ?", (self.stage,))
+
+    def add_pending(self, items: list):
+        """
+        Records new work. Urls already known to the stage keep their state.
+
+        :param items: list of tuples (url, payload), payload is a string or None
+        :return:
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.cur.executemany("INSERT OR IGNORE INTO work_state (stage, URL, state, payload, updated) "
+                             "VALUES (?, ?, 'pending', ?, ?)",
+                             [(self.stage, url, payload, now) for url, payload in items])
+
+    def set_state(self, urls: list, state: str):
+        """
+        Sets the state of the given urls, urls not known to the stage are added.
+
+        :param urls: urls to update
+        :param state: one of PENDING, IN_FLIGHT, DONE
+        :return:
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.cur.executemany("INSERT INTO work_state (stage, URL, state, updated) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT(stage, URL) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                             [(self.stage, url, state, now) for url in urls])
+
+    def mark_in_flight(self, urls: list):
+        """
+        Marks the urls as handed to a worker.
+        """
+        self.set_state(urls, IN_FLIGHT)
+
+    def mark_done(self, urls: list):
+        """
+        Marks the urls as done, needs to be called in the transaction writing their results.
+        """
+        self.set_state(urls, DONE)
+
+    def unfinished(self) -> list:
+        """
+        Retrieves the work which isn't done.
+        :return: list of tuples (url, payload)
+        """
+        self.cur.execute("SELECT URL, payload FROM work_state WHERE stage = ? AND state != 'done'", (self.stage,))
+        return self.cur.fetchall()
+
+    def done(self) -> set:
+        """
+        Retrieves the urls which are done.
+        :return: set of urls
+        """
+        self.cur.execute("SELECT URL FROM work_state WHERE stage = ? AND state = 'done'", (self.stage,))
+        return {row[0] for row in self.cur.fetchall()}
@@ -0,0 +1,118 @@
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+"""
+# Adaptive concurrency
+
+The stages spawn their workers at the upper bound, the AIMDController decides how many of them may have a request in
+flight at the same time. Every request reports its latency and outcome:
+
+- healthy response: after as many healthy responses as the current limit (roughly one round of all active workers),
+    the limit grows by 'increase' (additive increase)
+- 429, 5xx, connection error or latency above the target: the limit is multiplied by 'decrease' (multiplicative
+    decrease), at most once per cooldown so a burst of errors from the same round only counts once.
+
+The limit always stays between min_workers and max_workers.
+"""
+
+
+class AIMDController:
+    """
+    Thread safe gate limiting the number of concurrent requests with additive-increase/multiplicative-decrease.
+    """
+
+    def __init__(self, min_workers: int = 4, max_workers: int = 100, initial: int = None, increase: float = 1.0,
+                 decrease: float = 0.5, latency_target: float = None, cooldown: float = 2.0):
+        """
+        :param min_workers: lower bound of concurrent requests
+        :param max_workers: upper bound of concurrent requests, spawn at least this many workers
+        :param initial: limit to start with, defaults to min_workers
+        :param increase: number of requests added to the limit after a round of healthy responses
+        :param decrease: factor the limit is multiplied with when the server degrades, in (0, 1)
+        :param latency_target: seconds above which a response counts as degraded, None to only look at errors
+        :param cooldown: minimum seconds between two decreases
+        """
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("Bounds need to satisfy 1 <= min_workers <= max_workers")
+
+        if not 0 < decrease < 1:
+            raise ValueError("decrease needs to be in the open interval (0, 1)")
+
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+
+        self.limit = float(min_workers if initial is None else min(max(initial, min_workers), max_workers))
+        self.active = 0
+
+        self.__healthy = 0
+        self.__last_decrease = 0.0
+        self.__cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until the number of active requests is below the current limit and takes a slot.
+        :return:
+        """
+        with self.__cond:
+            while self.active >= int(self.limit):
+                self.__cond.wait()
+
+            self.active += 1
+
+    def release(self):
+        """
+        Returns a slot taken with acquire.
+        :return:
+        """
+        with self.__cond:
+            self.active -= 1
+            self.__cond.notify()
+
+    @contextmanager
+    def slot(self):
+        """
+        Context manager around acquire and release.
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record(self, latency: float, status: int = None, error: bool = False):
+        """
+        Reports the outcome of a request and adapts the limit.
+
+        :param latency: seconds the request took
+        :param status: http status code, None if no response was received
+        :param error: True if the request failed with a connection error or timeout
+        :return:
+        """
+        degraded = error or status == 429 or (status is not None and status >= 500) or \
+            (self.latency_target is not None and latency > self.latency_target)
+
+        with self.__cond:
+            if degraded:
+                self.__healthy = 0
+                now = monotonic()
+
+                if now - self.__last_decrease >= self.cooldown:
+                    self.limit = max(float(self.min_workers), self.limit * self.decrease)
+                    self.__last_decrease = now
+
+                    # TODO: logging and debug shit
+                    print(f"Concurrency decreased to {int(self.limit)}")
+                return
+
+            self.__healthy += 1
+            if self.__healthy >= int(self.limit):
+                self.__healthy = 0
+                self.limit = min(float(self.max_workers), self.limit + self.increase)
+
+                # more requests may run now.
+                self.__cond.notify_all()
@@ -0,0 +1,555 @@
+import datetime
+import json
+import sqlite3
+from contextlib import contextmanager
+
+from eth_loader import migrations
+from eth_loader.documents import document_hash, parse_series
+from eth_loader.payload import decode, encode
+
+"""
+# Database access
+
+All stages access their sqlite database through a Database. It owns the connection and only executes constant,
+?-parameterized statements, so sqlite's statement cache of the connection prepares every statement once per run
+instead of once per row, and values are bound as they are (no quote escaping, no copies of the payloads).
+
+## Tables
+- sites: hierarchy of video.ethz.ch, written by the indexer ('upsert_sites', 'upsert_site'). Sites the indexer failed
+    to load are kept with failed = 1 ('fail_sites'), so the next run loads them again as children of their parent.
+- metadata: series-metadata.json of the video sites, written by the metadata loader ('upsert_metadata')
+- episodes, streams: episode documents and their stream urls, written by the stream loader ('upsert_episode',
+    'upsert_stream')
+- episode_streams: which episode refers to which stream, written together with the episode
+
+The json documents of metadata and episodes are stored compressed (payload.py) and compared by their content_hash.
+They are parsed, hashed and compressed by the workers (documents.py), the upserts only store the results. The episode
+ids of a series are stored next to its metadata, so the stream loader doesn't need to parse the documents again.
+
+The tables are created and upgraded by the versioned migrations in migrations.py, the create_* method of a stage
+applies the ones its tables are missing. Every column a hot lookup filters on is indexed (sites.URL, sites.parent,
+URL / parent / deprecated of metadata and episodes, streams (URL, resolution)), so they are O(log n).
+
+Use a Database only from the thread that created it, unless it was opened with check_same_thread=False and the
+access is serialized by the caller.
+"""
+
+# outcome of the upsert of a versioned row (metadata, episodes, streams)
+ACTIVE = "active"
+REACTIVATED = "reactivated"
+INSERTED = "inserted"
+
+# parent is linked right away if it is already in the db (it is written before its children)
+# changed is the last time the validators of the site changed (or it was found), the metadata loader refreshes the
+# series changed since it last saw them.
+SITE_UPSERT = ("INSERT INTO sites (URL, IS_VIDEO, found, last_seen, etag, last_modified, parent, changed) "
+               "VALUES (?, ?, ?, ?, ?, ?, (SELECT key FROM sites WHERE URL = ?), ?) "
+               "ON CONFLICT(URL) DO UPDATE SET last_seen = excluded.last_seen, "
+               "changed = CASE WHEN sites.etag IS NOT excluded.etag OR sites.last_modified IS NOT excluded.last_modified "
+               "THEN excluded.changed ELSE sites.changed END, "
+               "etag = excluded.etag, last_modified = excluded.last_modified, "
+               "parent = COALESCE(sites.parent, excluded.parent), IS_VIDEO = excluded.IS_VIDEO, failed = 0")
+
+# failed sites are inserted as non video sites without validators, the next run loads them without a conditional
+# request. A site already in the database keeps its row and is only flagged.
+SITE_FAILED = ("INSERT INTO sites (URL, IS_VIDEO, found, parent, changed, failed) "
+               "VALUES (?, 0, ?, (SELECT key FROM sites WHERE URL = ?), ?, 1) "
+               "ON CONFLICT(URL) DO UPDATE SET failed = 1")
+
+
+def now() -> str:
+    """
+    Current time in the format of the found and last_seen columns.
+    """
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def content_hash(document: str) -> str:
+    """
+    SHA-256 of the canonical form of a json document (sorted keys, no whitespace), so documents which only differ in
+    formatting or key order get the same hash. Documents which aren't json (html error pages) are hashed as they are.
+
+    :param document: json document as received from the server
+    :return: hex digest
+    """
+    return document_hash(document)
+
+
+def flat_stream_keys(keys: list) -> list:
+    """
+    Stream keys of an episode as stored in its streams column. Older versions stored the rows of the key lookup
+    ([[12], [3]]) instead of the keys ([12, 3]), lookups that didn't find the stream were stored as null.
+
+    :param keys: parsed streams column
+    :return: list of the keys
+    """
+    flat = [key[0] if isinstance(key, list) else key for key in keys]
+    return [key for key in flat if key is not None]
+
+
+def parent_site(url: str) -> str:
+    """
+    Generates the url to the parent site.
+    :param url: url to get the parent of.
+    :return:
+    """
+    return url.rsplit("/", 1)[0] + ".html"
+
+
+class Database:
+    """
+    Connection to the database of the pipeline with typed access methods.
+    """
+
+    def __init__(self, file: str, check_same_thread: bool = True, cached_statements: int = 256):
+        """
+        :param file: path of the sqlite database, created if it doesn't exist
+        :param check_same_thread: False to allow the connection to be used by a thread other than the creating one
+        :param cached_statements: number of prepared statements kept by the connection
+        """
+        self.file = file
+        self.con = sqlite3.connect(file, check_same_thread=check_same_thread, cached_statements=cached_statements)
+        self.cur = self.con.cursor()
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commits the statements executed inside the with block, rolls them back if it raises.
+        """
+        with self.con:
+            yield self
+
+    def schema_version(self, component: str) -> int:
+        """
+        Version of the tables of a component, 0 if no migration was recorded for it.
+
+        :param component: name of the table group like 'sites' or 'metadata'
+        :return:
+        """
+        self.cur.execute("CREATE TABLE IF NOT EXISTS schema_version "
+                         "(component TEXT PRIMARY KEY, version INTEGER NOT NULL, migrated TEXT)")
+        self.cur.execute("SELECT version FROM schema_version WHERE component = ?", (component,))
+        row = self.cur.fetchone()
+        return 0 if row is None else row[0]
+
+    def migrate(self, component: str, steps: list) -> int:
+        """
+        Applies the migrations of a component newer than its recorded version, each one in its own transaction
+        together with the new version, see migrations.py.
+
+        :param component: name of the table group like 'sites' or 'metadata'
+        :param steps: list of tuples (version, description, function(db)) in ascending order of version
+        :return: version of the component after the migration
+        """
+        version = self.schema_version(component)
+
+        for target, description, migration in steps:
+            if target <= version:
+                continue
+
+            with self.transaction():
+                migration(self)
+                self.cur.execute("INSERT INTO schema_version (component, version, migrated) VALUES (?, ?, ?) "
+                                 "ON CONFLICT(component) DO UPDATE SET version = excluded.version, "
+                                 "migrated = excluded.migrated", (component, target, now()))
+
+            # TODO: logger and debug shit
+            print(f"Migrated {component} to version {target}: {description}")
+            version = target
+
+        return version
+
+    def table_exists(self, table: str) -> bool:
+        """
+        Checks if a table exists in the database.
+        """
+        self.cur.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name = ?", (table,))
+        return self.cur.fetchone() is not None
+
+    def ensure_column(self, table: str, column: str, declaration: str) -> bool:
+        """
+        Adds a column to an existing table if it isn't present yet. Used to upgrade databases created by older versions.
+
+        :param table: name of the table
+        :param column: name of the column to add
+        :param declaration: type and constraints of the column like 'TEXT' or 'INTEGER DEFAULT 0'
+        :return: True if the column was added
+        """
+        self.cur.execute(f"PRAGMA table_info({table})")
+        if column in [row[1] for row in self.cur.fetchall()]:
+            return False
+
+        self.cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+
+    def batches(self, table: str, columns: str, where: str = "1", batch_size: int = 500):
+        """
+        Iterates over the rows of a table in batches of ascending key, so only one batch of payloads is held in memory.
+        The statements executed by the caller for a batch are committed before the next batch is read, the rows are
+        selected by key range, so rows the caller changed can't be read twice.
+
+        :param table: name of the table, needs a key column
+        :param columns: columns to select after the key like 'json' or 'json, streams'
+        :param where: condition the rows need to match
+        :param batch_size: rows per batch
+        :return: generator of lists of tuples (key, *columns)
+        """
+        last = None
+
+        while True:
+            self.cur.execute(f"SELECT key, {columns} FROM {table} WHERE ({where}) AND (? IS NULL OR key > ?) "
+                             f"ORDER BY key LIMIT ?", (last, last, batch_size))
+            rows = self.cur.fetchall()
+
+            if len(rows) == 0:
+                return
+
+            yield rows
+
+            self.commit()
+            last = rows[-1][0]
+
+    def backfill_content_hash(self, table: str):
+        """
+        Computes the content_hash of the rows of a table written before the column existed.
+
+        :param table: name of the table with a json and a content_hash column
+        :return:
+        """
+        for rows in self.batches(table, "json", "content_hash IS NULL AND json IS NOT NULL"):
+            self.cur.executemany(f"UPDATE {table} SET content_hash = ? WHERE key = ?",
+                                 [(content_hash(decode(document)), key) for key, document in rows])
+
+    def compress_payloads(self, table: str) -> int:
+        """
+        Compresses the json of the rows written as TEXT by older versions, see payload.py. The file only shrinks after
+        a VACUUM.
+
+        :param table: name of the table with a json column
+        :return: number of compressed rows
+        """
+        compressed = 0
+
+        for rows in self.batches(table, "json", "typeof(json) = 'text'"):
+            self.cur.executemany(f"UPDATE {table} SET json = ? WHERE key = ?",
+                                 [(encode(document), key) for key, document in rows])
+            compressed += len(rows)
+
+        return compressed
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # sites
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def create_sites(self):
+        """
+        Creates the sites table with the dummy root entry or migrates the one of an older version.
+        :return:
+        """
+        self.migrate("sites", migrations.SITES)
+
+    def known_sites(self) -> list:
+        """
+        Validators of all sites except the root.
+        :return: list of tuples (URL, IS_VIDEO, etag, last_modified)
+        """
+        self.cur.execute("SELECT URL, IS_VIDEO, etag, last_modified FROM sites WHERE key > 0")
+        return self.cur.fetchall()
+
+    def count_sites(self) -> int:
+        self.cur.execute("SELECT COUNT(*) FROM sites")
+        return self.cur.fetchone()[0]
+
+    def upsert_sites(self, sites: list, timestamp: str = None):
+        """
+        Inserts new sites, updates last seen, validators and (missing) parent of the sites already in the database.
+
+        :param sites: list of tuples (url, is_video, etag, last_modified)
+        :param timestamp: found / last seen time, defaults to now
+        :return:
+        """
+        timestamp = now() if timestamp is None else timestamp
+        self.cur.executemany(SITE_UPSERT, [(url, a_video, timestamp, timestamp, etag, last_modified, parent_site(url),
+                                            timestamp) for url, a_video, etag, last_modified in sites])
+
+    def upsert_site(self, url: str, is_video: int, etag: str = None, last_modified: str = None) -> bool:
+        """
+        Upsert of a single site, see upsert_sites.
+
+        :return: True if the site is new
+        """
+        new = self.site_key(url) == -1
+        self.upsert_sites([(url, is_video, etag, last_modified)])
+        return new
+
+    def touch_sites(self, urls: list, timestamp: str = None):
+        """
+        Sets the last seen time of the sites.
+
+        :param urls: urls of the sites
+        :param timestamp: last seen time, defaults to now
+        :return:
+        """
+        timestamp = now() if timestamp is None else timestamp
+        self.cur.executemany("UPDATE sites SET last_seen = ?, failed = 0 WHERE URL IS ?",
+                             [(timestamp, url) for url in urls])
+
+    def fail_sites(self, urls: list, timestamp: str = None):
+        """
+        Flags the sites which couldn't be loaded, sites not in the database yet are inserted with their parent.
+
+        :param urls: urls of the sites
+        :param timestamp: found time of new sites, defaults to now
+        :return:
+        """
+        timestamp = now() if timestamp is None else timestamp
+        self.cur.executemany(SITE_FAILED, [(url, timestamp, parent_site(url), timestamp) for url in urls])
+
+    def site_key(self, url: str) -> int:
+        """
+        Key of the site with the given url.
+
+        :param url: url of the site
+        :return: key or -1 if the url isn't in the database
+        """
+        self.cur.execute("SELECT key FROM sites WHERE URL IS ?", (url,))
+        row = self.cur.fetchone()
+        return -1 if row is None else row[0]
+
+    def site_keys(self) -> dict:
+        """
+        Key of every site.
+        :return: dict url: key
+        """
+        self.cur.execute("SELECT key, URL FROM sites")
+        return {url: key for key, url in self.cur.fetchall()}
+
+    def unlinked_sites(self) -> list:
+        """
+        Sites without a parent.
+        :return: list of tuples (key, URL)
+        """
+        self.cur.execute("SELECT key, URL FROM sites WHERE parent IS NULL")
+        return self.cur.fetchall()
+
+    def set_parents(self, parents: list):
+        """
+        Links sites to their parent.
+
+        :param parents: list of tuples (parent key, key)
+        :return:
+        """
+        self.cur.executemany("UPDATE sites SET parent = ? WHERE key = ?", parents)
+
+    def video_sites(self) -> list:
+        """
+        Video sites with the validators of their latest active metadata entry, NULL if it wasn't downloaded yet.
+        :return: list of tuples (key, URL, etag, last_modified, site changed, metadata last_seen)
+        """
+        self.cur.execute("SELECT s.key, s.URL, m.etag, m.last_modified, s.changed, m.last_seen FROM sites s "
+                         "LEFT JOIN metadata m ON m.key = (SELECT MAX(key) FROM metadata "
+                         "WHERE parent = s.key AND deprecated = 0) "
+                         "WHERE s.IS_VIDEO=1")
+        return self.cur.fetchall()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # metadata
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def create_metadata(self):
+        """
+        Creates the metadata table or migrates the one of an older version.
+        :return:
+        """
+        self.migrate("metadata", migrations.METADATA)
+
+    def upsert_metadata(self, parent_id: int, url: str, payload: bytes, digest: str, etag: str = None,
+                        last_modified: str = None, episodes: list = None) -> str:
+        """
+        Stores a downloaded series-metadata.json. An identical active entry only gets its last seen time and
+        validators updated, an identical deprecated entry is reactivated (and the other entries of the site
+        deprecated), otherwise a new entry is inserted.
+
+        :param parent_id: key of the site in the sites table
+        :param url: url of the series-metadata.json
+        :param payload: json document compressed with payload.encode
+        :param digest: content hash of the document
+        :param etag: ETag of the response
+        :param last_modified: Last-Modified of the response
+        :param episodes: ids of the episodes of the series, None if the document has none
+        :return: ACTIVE, REACTIVATED or INSERTED
+        """
+        timestamp = now()
+
+        self.cur.execute("SELECT key, deprecated FROM metadata WHERE parent = ? AND URL = ? AND content_hash = ? "
+                         "ORDER BY deprecated LIMIT 1", (parent_id, url, digest))
+        row = self.cur.fetchone()
+
+        if row is not None and row[1] == 0:
+            self.cur.execute("UPDATE metadata SET last_seen = ?, etag = ?, last_modified = ? WHERE key = ?",
+                             (timestamp, etag, last_modified, row[0]))
+            return ACTIVE
+
+        if row is not None:
+            self.cur.execute("UPDATE metadata SET deprecated = 1 WHERE parent = ? AND URL = ?", (parent_id, url))
+            self.cur.execute("UPDATE metadata SET deprecated = 0, last_seen = ?, etag = ?, last_modified = ? "
+                             "WHERE key = ?", (timestamp, etag, last_modified, row[0]))
+            return REACTIVATED
+
+        self.cur.execute("INSERT INTO metadata "
+                         "(parent, URL, json, found, last_seen, etag, last_modified, content_hash, episodes) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (parent_id, url, payload, timestamp, timestamp, etag, last_modified, digest,
+                          None if episodes is None else json.dumps(episodes)))
+        return INSERTED
+
+    def touch_metadata(self, parent_id: int, url: str):
+        """
+        Sets the last seen time of the active metadata entries of a site to now.
+
+        :param parent_id: key of the site in the sites table
+        :param url: url of the series-metadata.json
+        :return:
+        """
+        self.cur.execute("UPDATE metadata SET last_seen = ? WHERE parent = ? AND URL = ? AND deprecated = 0",
+                         (now(), parent_id, url))
+
+    def active_series(self) -> list:
+        """
+        All active metadata entries with the ids of their episodes.
+        :return: list of tuples (key, URL, list of episode ids or None)
+        """
+        self.cur.execute("SELECT key, URL, episodes FROM metadata WHERE deprecated = 0")
+        return [(key, url, None if episodes is None else json.loads(episodes))
+                for key, url, episodes in self.cur.fetchall()]
+
+    def backfill_episodes(self):
+        """
+        Extracts the episode ids of the metadata entries written before the column existed.
+        :return:
+        """
+        for rows in self.batches("metadata", "json", "episodes IS NULL AND json IS NOT NULL"):
+            updates = []
+            for key, document in rows:
+                episodes = parse_series(decode(document))[1]
+                if episodes is not None:
+                    updates.append((json.dumps(episodes), key))
+
+            self.cur.executemany("UPDATE metadata SET episodes = ? WHERE key = ?", updates)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # episodes and streams
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def create_episodes(self):
+        """
+        Creates the episodes and streams table or migrates the ones of an older version.
+        :return:
+        """
+        self.migrate("episodes", migrations.EPISODES)
+        self.migrate("streams", migrations.STREAMS)
+
+    def upsert_episode(self, parent_id: int, url: str, payload: bytes, digest: str, stream_keys: list) -> str:
+        """
+        Stores a downloaded episode. An identical active entry is kept, an identical deprecated entry is reactivated
+        (and the other entries of the episode deprecated), otherwise a new entry is inserted.
+
+        :param parent_id: key of the metadata entry of the series
+        :param url: url of the episode
+        :param payload: json document of the episode compressed with payload.encode
+        :param digest: content hash of the document
+        :param stream_keys: keys of the streams of the episode in the streams table
+        :return: ACTIVE, REACTIVATED or INSERTED
+        """
+        stream_string = json.dumps(stream_keys)
+
+        self.cur.execute("SELECT key, deprecated FROM episodes "
+                         "WHERE parent = ? AND URL = ? AND content_hash = ? AND streams = ? "
+                         "ORDER BY deprecated LIMIT 1", (parent_id, url, digest, stream_string))
+        row = self.cur.fetchone()
+
+        if row is not None and row[1] == 0:
+            return ACTIVE
+
+        if row is not None:
+            self.cur.execute("UPDATE episodes SET deprecated = 1 WHERE parent = ? AND URL = ?", (parent_id, url))
+            self.cur.execute("UPDATE episodes SET deprecated = 0 WHERE key = ?", (row[0],))
+            return REACTIVATED
+
+        self.cur.execute("INSERT INTO episodes (parent, URL, json, found, streams, content_hash) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (parent_id, url, payload, now(), stream_string, digest))
+        self.link_streams(self.cur.lastrowid, stream_keys)
+        return INSERTED
+
+    def normalize_episode_streams(self):
+        """
+        Rewrites the streams column of the episodes written by older versions as a flat list of keys (see
+        flat_stream_keys), so they compare equal to the ones written by upsert_episode.
+        :return:
+        """
+        for rows in self.batches("episodes", "streams", "streams IS NOT NULL"):
+            updates = []
+            for key, streams in rows:
+                flat = json.dumps(flat_stream_keys(json.loads(streams)))
+                if flat != streams:
+                    updates.append((flat, key))
+
+            self.cur.executemany("UPDATE episodes SET streams = ? WHERE key = ?", updates)
+
+    def link_streams(self, episode_key: int, stream_keys: list):
+        """
+        Records that an episode refers to the given streams.
+
+        :param episode_key: key of the episode
+        :param stream_keys: keys of its streams
+        :return:
+        """
+        self.cur.executemany("INSERT OR IGNORE INTO episode_streams (episode_key, stream_key) VALUES (?, ?)",
+                             [(episode_key, stream_key) for stream_key in stream_keys])
+
+    def backfill_episode_streams(self):
+        """
+        Fills episode_streams from the streams column of the episodes written before the table existed, the nested
+        keys of older versions are flattened (see flat_stream_keys).
+        :return:
+        """
+        for rows in self.batches("episodes", "streams", "streams IS NOT NULL"):
+            for key, streams in rows:
+                self.link_streams(key, flat_stream_keys(json.loads(streams)))
+
+    def upsert_stream(self, url: str, resolution: str) -> int:
+        """
+        Stores a stream, reactivates it if it was deprecated.
+
+        :param url: url of the stream
+        :param resolution: resolution of the stream like '1920 x 1080'
+        :return: key of the stream
+        """
+        self.cur.execute("SELECT key, deprecated FROM streams WHERE URL = ? AND resolution = ? "
+                         "ORDER BY deprecated LIMIT 1", (url, resolution))
+        row = self.cur.fetchone()
+
+        if row is not None:
+            if row[1] == 1:
+                self.cur.execute("UPDATE streams SET deprecated = 0 WHERE key = ?", (row[0],))
+            return row[0]
+
+        self.cur.execute("INSERT INTO streams (URL, resolution, found) VALUES (?, ?, ?)", (url, resolution, now()))
+        return self.cur.lastrowid
+
+    def deprecate_streams(self) -> int:
+        """
+        Deprecates the active streams no active episode refers to anymore, in a single statement using the index on
+        episode_streams.stream_key.
+        :return: number of deprecated streams
+        """
+        self.cur.execute("UPDATE streams SET deprecated = 1 WHERE deprecated = 0 AND NOT EXISTS "
+                         "(SELECT 1 FROM episode_streams es JOIN episodes e ON e.key = es.episode_key "
+                         "WHERE es.stream_key = streams.key AND e.deprecated = 0)")
+        return self.cur.rowcount
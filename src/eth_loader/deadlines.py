@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+from time import monotonic
+
+import requests as rq
+
+"""
+# Deadlines, stall detection and tail latency
+
+The connect and read timeouts of the Transport only bound the time between two packets, a server trickling a page
+byte by byte keeps a worker busy forever. So the Transport additionally has:
+
+- a deadline: seconds a whole attempt (headers and body) may take, exceeding it raises DeadlineExceeded
+- a StallDetector for downloads: a download whose throughput stays below min_rate for a whole window is aborted
+- a LatencyTracker: latencies of the recent requests, its p95 is the delay after which a GET is hedged (a duplicate is
+    sent and the first answer wins), so the slowest few percent of the requests don't set the duration of a stage.
+
+DeadlineExceeded is a requests.Timeout, so it is retried like every other timeout.
+"""
+
+
+class DeadlineExceeded(rq.Timeout):
+    """
+    The request took longer than its deadline or stalled.
+    """
+
+
+class LatencyTracker:
+    """
+    Thread safe window of the latest request latencies.
+    """
+
+    def __init__(self, window: int = 1000, min_samples: int = 20):
+        """
+        :param window: number of latencies kept
+        :param min_samples: number of latencies needed before a percentile is reported
+        """
+        self.min_samples = min_samples
+
+        self.__latencies = deque(maxlen=window)
+        self.__lock = threading.Lock()
+
+    def record(self, latency: float):
+        """
+        Adds the latency of a completed request.
+
+        :param latency: seconds the request took
+        :return:
+        """
+        with self.__lock:
+            self.__latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        """
+        Percentile of the recorded latencies.
+
+        :param p: percentile in [0, 100]
+        :return: latency in seconds, None if less than min_samples latencies are known
+        """
+        with self.__lock:
+            if len(self.__latencies) < self.min_samples:
+                return None
+
+            ordered = sorted(self.__latencies)
+
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class StallDetector:
+    """
+    Tracks the progress of a download and detects when the throughput stays below a minimum for a whole window.
+    """
+
+    def __init__(self, min_rate: float, window: float = 30.0):
+        """
+        :param min_rate: minimum bytes per second
+        :param window: seconds over which the throughput is measured
+        """
+        self.min_rate = min_rate
+        self.window = window
+
+        self.__start = monotonic()
+        self.__received = 0
+
+    def progress(self, amount: int):
+        """
+        Reports received bytes, raises DeadlineExceeded if the download stalled.
+
+        :param amount: number of bytes received since the last call
+        :return:
+        """
+        self.__received += amount
+        elapsed = monotonic() - self.__start
+
+        if elapsed < self.window:
+            return
+
+        if self.__received / elapsed < self.min_rate:
+            raise DeadlineExceeded(f"Stalled at {self.__received / elapsed:.0f} bytes/s over {elapsed:.0f}s")
+
+        # next window
+        self.__start = monotonic()
+        self.__received = 0
@@ -0,0 +1,213 @@
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from eth_loader.payload import encode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+# Parsed json documents
+
+The series-metadata.json documents are parsed exactly once, by the worker which downloaded them. The worker hands a
+record with everything the writer needs (hash, compressed payload, episode ids or streams) to the writer, which then
+only executes statements.
+
+- loads: orjson if it is installed, the json module otherwise
+- document_hash: SHA-256 of the canonical form of a document. The canonical form is always dumped with the json module,
+    so the hashes don't depend on the backend used for parsing.
+- parse_series / parse_episode: extract the episode ids of a series / the streams of an episode
+"""
+
+
+def loads(document):
+    """
+    Parses a json document.
+
+    :param document: bytes or str
+    :return: parsed document
+    :raises json.JSONDecodeError: if it isn't valid json
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(document)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the json module (integers > 64 bit for example), let the json module decide
+            pass
+
+    return json.loads(document)
+
+
+def canonical_hash(parsed) -> str:
+    """
+    SHA-256 of the canonical form (sorted keys, no whitespace) of a parsed json document.
+    """
+    canonical = json.dumps(parsed, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def document_hash(document, parsed=None) -> str:
+    """
+    SHA-256 of the canonical form of a json document, so documents which only differ in formatting or key order get
+    the same hash. Documents which aren't json (html error pages) are hashed as they are.
+
+    :param document: json document as received from the server, bytes or str
+    :param parsed: the parsed document if it was already parsed, None to parse it
+    :return: hex digest
+    """
+    if parsed is None:
+        try:
+            parsed = loads(document)
+        except json.JSONDecodeError:
+            raw = document.encode("utf-8") if isinstance(document, str) else document
+            return hashlib.sha256(raw).hexdigest()
+
+    return canonical_hash(parsed)
+
+
+@dataclass
+class SeriesRecord:
+    """
+    Downloaded series-metadata.json of a series.
+    """
+    url: str
+    site_url: str
+    parent_id: int
+    status: int
+    etag: str = None
+    last_modified: str = None
+    payload: bytes = None
+    content_hash: str = None
+    # None if the document isn't json or has no episodes
+    episodes: List[str] = None
+
+
+@dataclass
+class EpisodeRecord:
+    """
+    Downloaded series-metadata.json of an episode.
+    """
+    url: str
+    parent_id: int
+    status: int
+    payload: bytes = None
+    content_hash: str = None
+    # (url, resolution) of the presentations
+    streams: List[Tuple[str, str]] = field(default_factory=list)
+
+
+def parse_series(raw) -> Tuple[str, List[str]]:
+    """
+    Parses the series-metadata.json of a series.
+
+    :param raw: document as received from the server
+    :return: content hash and the ids of the episodes, None if it isn't json or has no episodes
+    """
+    try:
+        series = loads(raw)
+    except json.JSONDecodeError:
+        return document_hash(raw), None
+
+    episodes = series.get("episodes") if isinstance(series, dict) else None
+
+    if episodes is None:
+        return canonical_hash(series), None
+
+    ids = []
+    for ep in episodes:
+        ep_id = ep.get("id")
+
+        # verify existence of episode id.
+        if ep_id is None:
+            # TODO: logging and debug shit
+            print(f"Episode without id: {ep}")
+            continue
+
+        ids.append(ep_id)
+
+    return canonical_hash(series), ids
+
+
+def parse_episode(raw) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Parses the series-metadata.json of an episode.
+
+    :param raw: document as received from the server
+    :return: content hash and the (url, resolution) of the presentations of the selected episode
+    :raises json.JSONDecodeError: if it isn't valid json
+    """
+    episode = loads(raw)
+    streams = []
+
+    # selectedEpisode.media.presentations, every level may be missing
+    presentations = ((episode.get("selectedEpisode") or {}).get("media") or {}).get("presentations") or []
+
+    for p in presentations:
+        width = p.get("width")
+
+        # try to retrieve width, ignore if it doesn't exist
+        # TODO: proceed but put warning
+        if width is None:
+            # TODO: logging and debug shit
+            print(f"Failed to retrieve WIDTH {width}")
+            continue
+
+        height = p.get("height")
+
+        # try to retrieve height, ignore if it doesn't exist
+        # TODO: proceed but put warning
+        if height is None:
+            # TODO: logging and debug shit
+            print(f"Failed to retrieve HEIGHT {height}")
+            continue
+
+        stream_url = p.get("url")
+
+        # verify url key exists
+        if stream_url is None:
+            # TODO: logging and debug shit
+            print(f"Failed to retrieve URL {p}")
+            continue
+
+        streams.append((stream_url, f"{width} x {height}"))
+
+    return canonical_hash(episode), streams
+
+
+def series_record(url: str, site_url: str, parent_id: int, status: int, raw: bytes = None, etag: str = None,
+                  last_modified: str = None) -> SeriesRecord:
+    """
+    Builds the record of a downloaded series, parses and compresses the document if there is one.
+    """
+    record = SeriesRecord(url=url, site_url=site_url, parent_id=parent_id, status=status, etag=etag,
+                          last_modified=last_modified)
+
+    if raw is not None:
+        record.content_hash, record.episodes = parse_series(raw)
+        record.payload = encode(raw)
+
+    return record
+
+
+def episode_record(url: str, parent_id: int, status: int, raw: bytes = None) -> EpisodeRecord:
+    """
+    Builds the record of a downloaded episode, parses and compresses the document if there is one. Documents which
+    aren't json are dropped, the record has no payload then.
+    """
+    record = EpisodeRecord(url=url, parent_id=parent_id, status=status)
+
+    if raw is not None:
+        try:
+            record.content_hash, record.streams = parse_episode(raw)
+        except json.JSONDecodeError:
+            # TODO: logging and debug shit
+            print(f"Failed to load raw content of {url},\n{raw[:200]}")
+            return record
+
+        record.payload = encode(raw)
+
+    return record
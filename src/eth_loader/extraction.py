@@ -0,0 +1,143 @@
+import html
+import re
+import threading
+from typing import List, Tuple
+
+from lxml import etree
+
+"""
+# Extraction of the crawl relevant information from a site
+
+The indexer only needs to know two things about a site: does it contain the video player (<vp-episode-page>) and
+which links are inside the 'newsListBox' divs.
+
+- extract_page: fast path, scans the raw bytes. Stops at the video element and otherwise only matches the link boxes.
+    Falls back to extract_page_tree if the markup doesn't look like expected: a box which doesn't hold exactly one
+    link, or the video marker inside a script or comment.
+- extract_page_tree: builds the full tree, with a parser per thread and pre-compiled XPath expressions.
+"""
+
+# start of a <vp-episode-page> element, not just a tag name starting like it
+VIDEO_PATTERN = re.compile(rb"<vp-episode-page[\s/>]", re.IGNORECASE)
+LINK_BOX_MARKER = b'class="newsListBox"'
+
+LINK_BOX_PATTERN = re.compile(rb'<div\s+class="newsListBox"\s*>')
+# the box starts with its <a href="...">
+LINK_PATTERN = re.compile(rb'\s*<a\s[^>]*?\bhref="([^"]*)"')
+ANCHOR_PATTERN = re.compile(rb"<a[\s>]", re.IGNORECASE)
+# opening and closing divs, to find the end of a box
+DIV_PATTERN = re.compile(rb"<(/?)div[\s>]", re.IGNORECASE)
+
+VIDEO_XPATH = etree.XPath("//vp-episode-page")
+LINK_BOX_XPATH = etree.XPath("//div[@class='newsListBox']/a/@href")
+
+_local = threading.local()
+
+
+def get_parser() -> etree.HTMLParser:
+    """
+    Returns the html parser of the calling thread. Parsers can't be shared between threads but can be reused.
+    :return:
+    """
+    parser = getattr(_local, "parser", None)
+
+    if parser is None:
+        parser = etree.HTMLParser(encoding="utf-8")
+        _local.parser = parser
+
+    return parser
+
+
+def extract_page_tree(content: bytes) -> Tuple[bool, List[str]]:
+    """
+    Parses the full site and extracts if it contains a video and the links of the 'newsListBox' divs.
+
+    :param content: raw body of the site
+    :return: tuple (is_video, hrefs), hrefs is empty if the site contains a video
+    """
+    tree = etree.fromstring(content, get_parser())
+
+    # empty document
+    if tree is None:
+        return False, []
+
+    if len(VIDEO_XPATH(tree)) > 0:
+        return True, []
+
+    return False, [str(href) for href in LINK_BOX_XPATH(tree)]
+
+
+def in_script_or_comment(content: bytes, position: int) -> bool:
+    """
+    Checks if the position of the raw body lies inside a <script> element or a comment.
+
+    :param content: raw body of the site
+    :param position: offset into content
+    :return:
+    """
+    head = content[:position]
+
+    comment = head.rfind(b"<!--")
+    if comment != -1 and head.find(b"-->", comment) == -1:
+        return True
+
+    lower = head.lower()
+    script = lower.rfind(b"<script")
+    return script != -1 and lower.find(b"</script", script) == -1
+
+
+def box_content(content: bytes, start: int) -> bytes:
+    """
+    Content of the div opened right before start, up to its closing tag (or the end of the site).
+
+    :param content: raw body of the site
+    :param start: offset just behind the opening tag of the div
+    :return:
+    """
+    depth = 1
+    for div in DIV_PATTERN.finditer(content, start):
+        depth += -1 if div.group(1) else 1
+
+        if depth == 0:
+            return content[start:div.start()]
+
+    return content[start:]
+
+
+def extract_page(content: bytes) -> Tuple[bool, List[str]]:
+    """
+    Extracts if the site contains a video and the links of the 'newsListBox' divs without building a tree.
+    Returns the same result as extract_page_tree, sites which don't have the layout of video.ethz.ch (one link per
+    box) are handed to it.
+
+    :param content: raw body of the site
+    :return: tuple (is_video, hrefs), hrefs is empty if the site contains a video
+    """
+    video = VIDEO_PATTERN.search(content)
+    if video is not None:
+        # only the element counts, let the parser decide about the marker in a script or comment
+        if in_script_or_comment(content, video.start()):
+            return extract_page_tree(content)
+
+        return True, []
+
+    boxes = content.count(LINK_BOX_MARKER)
+    if boxes == 0:
+        return False, []
+
+    hrefs = []
+    for opening in LINK_BOX_PATTERN.finditer(content):
+        box = box_content(content, opening.end())
+        link = LINK_PATTERN.match(box)
+
+        # some box doesn't have the expected layout (exactly one link, right at its start), let the parser handle it.
+        if link is None or len(ANCHOR_PATTERN.findall(box)) != 1:
+            return extract_page_tree(content)
+
+        hrefs.append(link.group(1))
+
+    # a box the pattern didn't match
+    if len(hrefs) != boxes:
+        return extract_page_tree(content)
+
+    return False, [html.unescape(href.decode("utf-8")) for href in hrefs]
@@ -0,0 +1,103 @@
+import hashlib
+import math
+import threading
+
+"""
+# Frontier deduplication
+
+Sites are reachable from several parents, so the same url is found many times during a crawl. The VisitedSet remembers
+every url that was already scheduled, so each url is fetched at most once per run.
+
+By default the urls are kept in a python set. For very large crawls the set can be backed by a BloomFilter, which
+needs a fixed amount of memory but may (with the configured probability) report an unseen url as already visited.
+"""
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings. Never reports a false negative, reports false positives with the probability
+    error_rate as long as less than capacity items are added.
+    """
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.001):
+        """
+        :param capacity: expected number of items
+        :param error_rate: probability of a false positive once capacity items were added
+        """
+        if capacity < 1:
+            raise ValueError("capacity needs to be at least 1")
+
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate needs to be in the open interval (0, 1)")
+
+        # optimal number of bits and hash functions for the given capacity and error rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, item: str):
+        """
+        Generates the bit positions of the item with double hashing.
+        :param item: item to hash
+        :return:
+        """
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, item: str) -> bool:
+        for pos in self.__positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+
+        return True
+
+    def add(self, item: str):
+        """
+        Adds the item to the filter.
+        :param item: item to add
+        :return:
+        """
+        for pos in self.__positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+
+class VisitedSet:
+    """
+    Thread safe set of the urls already scheduled in the current run.
+    """
+
+    def __init__(self, bloom_capacity: int = None, error_rate: float = 0.001):
+        """
+        :param bloom_capacity: if given, the set is backed by a BloomFilter of this capacity instead of a python set.
+        :param error_rate: false positive rate of the BloomFilter, ignored without bloom_capacity.
+        """
+        if bloom_capacity is None:
+            self.__seen = set()
+        else:
+            self.__seen = BloomFilter(bloom_capacity, error_rate)
+
+        self.__lock = threading.Lock()
+        self.count = 0
+
+    def add_if_new(self, url: str) -> bool:
+        """
+        Marks the url as visited.
+
+        :param url: url to mark
+        :return: True if the url wasn't visited before, so the caller needs to schedule it.
+        """
+        with self.__lock:
+            if url in self.__seen:
+                return False
+
+            self.__seen.add(url)
+            self.count += 1
+            return True
+
+    def __contains__(self, url: str) -> bool:
+        with self.__lock:
+            return url in self.__seen
@@ -1,16 +1,20 @@
-import datetime
-import os.path
 import sqlite3
 
 import traceback
-import requests as rq
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
 from lxml.etree import _Element
 import multiprocessing as mp
 from threading import Thread
-from time import sleep
-from queue import Empty
-from sqlite3 import *
+from time import monotonic
+from queue import Empty, Queue
+
+from eth_loader.checkpoint import WorkState
+from eth_loader.database import Database, now, parent_site
+from eth_loader.extraction import VIDEO_XPATH, extract_page
+from eth_loader.frontier import VisitedSet
+from eth_loader.transport import get_transport
+from eth_loader.work_tracker import STOP, WorkTracker
 
 """
 # Functionality of Class:
@@ -19,44 +23,34 @@ from sqlite3 import *
 - init: create the queues and initialize the attributes, connect to the database
 - index_video_eth: schedule all links (hrefs) found on the root site of video site of the eth for the workers.
     uses sub_index to add the first results to the ingest queue (can be switched to __sub_index func for debugging)
+    with resume=True, 'resume_targets' schedules only the sites the previous run didn't finish (checkpoint.WorkState)
 - spawn: spawns the workers and returns (doesn't wait for workers to exit)
-- dequeue: dequeues the results from the results queue, uses 'not_in_db' to insert only the new results into the db
-    uses 'workers_alive' to check if new results are still added to the queue, 
+- dequeue: dequeues the results from the results queue, uses 'write_batch' to insert or update them in batches
+    until the STOP sentinel put after the last result
 - gen_parent: create the linking to create the site hirarchie in the database with foreign keys.
-    uses 'get_url_id' to find the key of the parent. store the result in dict to make accessing faster (db is slow)
+    sites are linked when they are written, gen_parent links the rest with a single url:key dict and one transaction
     
 ## Worker life cycle
-- __indexer: try to dequeue, queue empty for 20s, exit, uses '__sub_index' to recursively search site
-- __sub_index: fetches page from arguments, checks if page is a video if so, put that in queue, and return
-    else, put no video in queue and  get all hrefs, make sure the parent matches, then add them to the todo queue
+- __indexer: dequeue until the STOP sentinel, uses '__sub_index' to recursively search site. The last worker to finish
+    a target (WorkTracker reaches zero) puts the STOP sentinels for the workers and the writer ('finish')
+- sub_index: puts a target on the todo queue, unless it was already scheduled in this run (visited set)
+- __sub_index: fetches page from arguments, checks if page is a video (extraction.extract_page) if so, put that in
+    queue, and return else, put no video in queue and  get all hrefs, make sure the parent matches, then add them to the todo queue
+    If the site is known from a previous run, the request is conditional (ETag / Last-Modified). On a 304 the site
+    isn't parsed, the children known from the previous run are scheduled instead.
+    With parse_processes, the worker only fetches the bytes and 'parse' hands them to a pool of parser processes, so
+    the parsing isn't limited to the one core the GIL allows.
 
 """
 
 
-def parent_site(url: str) -> str:
-    """
-    Generates the url to the parent site.
-    :param url: url to get the parent of.
-    :return:
-    """
-    snippets = url.split("/")
-    del snippets[-1]
-
-    url = snippets[0]
-    for i in range(1, len(snippets)):
-        url += "/" + snippets[i]
-
-    url += ".html"
-    return url
-
-
 def is_video(root: _Element) -> bool:
     """
     Checks if the video is present on the video.
     :param root: lxml.etree._Element, root element of the html
     :return:
     """
-    video = root.xpath("//vp-episode-page")
+    video = VIDEO_XPATH(root)
 
     if len(video) > 0:
         return True
@@ -70,7 +64,7 @@ class ConcurrentETHSiteIndexer:
     It tracks the parent site which contained the link to the current site.
     It also has a found tag which stores the date the site was found.
     """
-    def __init__(self, file: str, prefixes: list = None):
+    def __init__(self, file: str, prefixes: list = None, bloom_capacity: int = None, parse_processes: int = None):
         """
         Initializer for concurrent indexing of entire video.ethz.ch site.
 
@@ -78,19 +72,32 @@ class ConcurrentETHSiteIndexer:
 
         :param file: output where the video-series urls are stored. (at the time 6460 urls)
         :param prefixes: provide custom prefixes, main_header [campus, lectures, ...]
+        :param bloom_capacity: back the visited set by a bloom filter of this capacity to bound memory on huge crawls
+        :param parse_processes: parse the sites in a pool of this many processes, None to parse in the fetching thread
         """
         self.prefixes = ["/campus", "/conferences", "/events", "/speakers", "/lectures"]
         self.file = file
-        make_db = not os.path.exists(file)
 
-        self.sq_con = Connection(file)
-        self.sq_cur = self.sq_con.cursor()
+        self.db = Database(file)
+        self.db.create_sites()
 
-        if make_db:
-            self.init_db()
+        # validators and children of the sites found in previous runs, read only while the workers are running.
+        self.known_sites = {}
+        self.known_children = {}
 
-        self.to_download_queue = mp.Queue()
-        self.found_url_queue = mp.Queue(maxsize=100)
+        # urls already scheduled in this run, so every site is fetched at most once.
+        self.bloom_capacity = bloom_capacity
+        self.visited = VisitedSet(bloom_capacity)
+
+        self.tracker = WorkTracker()
+        self.work_state = WorkState(self.db.con, "index")
+
+        self.parse_processes = parse_processes
+        self.parse_pool: ProcessPoolExecutor = None
+
+        # only threads of this process use the queues, no need for the pickling and pipes of mp.Queue
+        self.to_download_queue = Queue()
+        self.found_url_queue = Queue(maxsize=100)
         self.threads = []
 
     def val_uri(self, url: str) -> bool:
@@ -114,31 +121,131 @@ class ConcurrentETHSiteIndexer:
 
         return False
 
-    def init_db(self):
+    def load_known_sites(self):
+        """
+        Loads the validators of all sites already in the database and the children of every site, so unchanged sites
+        can be revalidated with a conditional request instead of being downloaded and parsed again. The children
+        include the ones which failed to load, so they are loaded again even if their parent is unchanged.
+        :return:
+        """
+        self.known_sites = {}
+        self.known_children = {}
+
+        for url, a_video, etag, last_modified in self.db.known_sites():
+            self.known_sites[url] = {"is_video": a_video, "etag": etag, "last_modified": last_modified}
+            self.known_children.setdefault(parent_site(url), []).append(url)
+
+    def conditional_headers(self, url: str) -> dict:
         """
-        Initialises the database.
+        Generates the headers for a request of the given url. Adds If-None-Match and If-Modified-Since if validators
+        are known from a previous run.
+
+        :param url: full url of the site to request
         :return:
         """
-        self.sq_cur.execute("CREATE TABLE sites "
-                            "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
-                            "parent INTEGER, "
-                            "URL TEXT UNIQUE , "
-                            "IS_VIDEO INTEGER CHECK (IS_VIDEO >= 0 AND IS_VIDEO <= 1),"
-                            "found TEXT);")
+        headers = {"user-agent": "Mozilla Firefox"}
+        known = self.known_sites.get(url)
+
+        if known is not None:
+            if known["etag"] is not None:
+                headers["If-None-Match"] = known["etag"]
+            if known["last_modified"] is not None:
+                headers["If-Modified-Since"] = known["last_modified"]
+
+        return headers
+
+    def known_child_targets(self, url: str, prefix: str) -> list:
+        """
+        Generates the targets for the children of an unchanged site from the children found in the previous run.
+
+        :param url: full url of the unchanged site
+        :param prefix: prefix of the site, only children with identical prefix are returned
+        :return: list of tuples (full url, prefix) of the children
+        """
+        targets = []
+        for child in self.known_children.get(url, []):
+            uri = child.replace("https://www.video.ethz.ch", "")
 
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # verify it is on the same branch but not the same uri
+            if (prefix.split(".")[0] in uri) and (prefix != uri):
+                targets.append((child, uri))
 
-        # Dummy entry to have a root.
-        self.sq_cur.execute(f"INSERT INTO sites (key, parent, URL, IS_VIDEO, found) VALUES (0, -1, 'https://www.video.ethz.ch', 0, '{now}')")
-        print("Table Created")
+        return targets
 
-    def index_video_eth(self):
+    def index_video_eth(self, resume: bool = False):
         """
         Starts the indexing of the site.
+
+        :param resume: continue the previous run (only the sites it didn't finish), starts a full run if there is none
         :return:
         """
+        self.load_known_sites()
+        self.visited = VisitedSet(self.bloom_capacity)
+        self.tracker = WorkTracker()
+        self.start_parse_pool()
+
+        try:
+            if not (resume and self.resume_targets()):
+                self.seed()
+
+            self.spawn()
+
+            # nothing was scheduled, the workers would wait forever.
+            if self.tracker.pending == 0:
+                self.finish()
+
+            self.dequeue()
+
+            # TODO: logger and debug shit
+            print("Cleanup")
+            self.cleanup()
+            self.db.commit()
+        finally:
+            self.stop_parse_pool()
+
+    def start_parse_pool(self):
+        """
+        Starts the parser processes if parse_processes is set. The processes are started with 'spawn', forking a
+        process with running worker threads can deadlock it.
+        :return:
+        """
+        if self.parse_processes is None:
+            return
+
+        self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes, mp_context=mp.get_context("spawn"))
+
+    def stop_parse_pool(self):
+        """
+        Shuts the parser processes down.
+        :return:
+        """
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+    def parse(self, content: bytes) -> tuple:
+        """
+        Extracts the video flag and the links of a site, in a parser process if there is a pool. The calling thread
+        waits without holding the GIL.
+
+        :param content: raw bytes of the site
+        :return: tuple (is_video, hrefs) like extraction.extract_page
+        """
+        if self.parse_pool is None:
+            return extract_page(content)
+
+        return self.parse_pool.submit(extract_page, content).result()
+
+    def seed(self):
+        """
+        Starts a new full run, schedules all valid links of the root site.
+        :return:
+        """
+        self.work_state.reset()
+
         # load main site
-        resp = rq.get("https://www.video.ethz.ch/", headers={"user-agent": "Mozilla Firefox"})
+        resp = get_transport().get("https://www.video.ethz.ch/", headers={"user-agent": "Mozilla Firefox"},
+                                   stage="index")
 
         # get the html
         html = resp.content.decode("utf-8")
@@ -162,13 +269,29 @@ class ConcurrentETHSiteIndexer:
                     print(f"uri {uri}")
                     self.sub_index(f"https://www.video.ethz.ch{uri}", uri)
 
-        self.spawn()
-        self.dequeue()
+        self.work_state.add_pending([(f"https://www.video.ethz.ch{uri}", uri) for uri in uris])
+        self.db.commit()
+
+    def resume_targets(self) -> bool:
+        """
+        Schedules the sites the previous run didn't finish. Finished sites are marked as visited, so they aren't
+        fetched again.
+
+        :return: False if there is no previous run to resume
+        """
+        if not self.work_state.has_run():
+            return False
+
+        for url in self.work_state.done():
+            self.visited.add_if_new(url)
+
+        unfinished = self.work_state.unfinished()
+        for url, prefix in unfinished:
+            self.sub_index(url, prefix)
 
         # TODO: logger and debug shit
-        print("Cleanup")
-        self.cleanup()
-        self.sq_con.commit()
+        print(f"Resuming with {len(unfinished)} unfinished sites")
+        return True
 
     def __sub_index(self, url: str, prefix: str):
         """
@@ -183,41 +306,53 @@ class ConcurrentETHSiteIndexer:
         :return:
         """
         # load target site
-        resp = rq.get(url, headers={"user-agent": "Mozilla Firefox"})
-        # get the html
-        html = resp.content.decode("utf-8")
-
-        # prepare for xpath
-        tree = etree.HTML(html)
-        # x = tree.xpath("//a")
+        resp = get_transport().get(url, headers=self.conditional_headers(url), stage="index")
 
-        # get the box where the list of 'child organizers' are stored say d-infk/[list of all years.]
-        x = tree.xpath("//div[@class='newsListBox']/a")
+        # site unchanged since the last run, only mark it as seen and revisit the children known from the last run.
+        if resp.status_code == 304:
+            known = self.known_sites[url]
+            children = [] if known["is_video"] else self.known_child_targets(url, prefix)
 
-        # dump the site to the list of video urls if it matches
-        if is_video(tree):
-
-            # TODO: logger and debug shit
             print(f"put {url}")
-            self.found_url_queue.put({"url": url, "is_video": 1})
+            self.found_url_queue.put({"url": url, "is_video": known["is_video"], "not_modified": True,
+                                      "children": children})
+
+            for child, uri in children:
+                self.sub_index(child, uri)
             return
 
-        else:
+        # failed even after the retries of the transport, the site stays unfinished in the work state and is
+        # retried by a resumed run. It's flagged in the sites table, so the next run loads it again when its parent
+        # is unchanged.
+        if not resp.ok:
             # TODO: logger and debug shit
-            print(f"put {url}")
-            self.found_url_queue.put({"url": url, "is_video": 0})
+            print(f"Failed {url} with status {resp.status_code}")
+            self.found_url_queue.put({"url": url, "failed": True})
+            return
 
-        # find all <a> elements
-        for a in x:
-            a: _Element
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
 
-            # asure href is a key
-            if "href" in a.keys():
-                uri = a.attrib["href"]
+        # check for the video player and get the links of the box where the list of 'child organizers' are stored
+        # say d-infk/[list of all years.]
+        a_video, hrefs = self.parse(resp.content)
 
+        # the children are sent along with the site, so the writer can checkpoint them in the same transaction.
+        children = []
+        if not a_video:
+            for uri in hrefs:
                 # verify it is on the same branch but not the same uri
                 if (prefix.split(".")[0] in uri) and (prefix != uri):
-                    self.sub_index(f"https://www.video.ethz.ch{uri}", uri)
+                    children.append((f"https://www.video.ethz.ch{uri}", uri))
+
+        # dump the site to the list of video urls if it matches
+        # TODO: logger and debug shit
+        print(f"put {url}")
+        self.found_url_queue.put({"url": url, "is_video": int(a_video), "etag": etag, "last_modified": last_modified,
+                                  "children": children})
+
+        for child, uri in children:
+            self.sub_index(child, uri)
 
         # TODO: logger and debug shit
         print(f"Done {url}")
@@ -229,7 +364,16 @@ class ConcurrentETHSiteIndexer:
         """
         for worker in self.threads:
             worker: Thread
-            worker.join(10)
+            worker.join()
+
+    def finish(self):
+        """
+        Called once the last scheduled target is done. Stops the workers and the writer.
+        :return:
+        """
+        # every worker puts the sentinel back before exiting, so one is enough for all of them.
+        self.to_download_queue.put(STOP)
+        self.found_url_queue.put(STOP)
 
     def spawn(self, threads: int = 100):
         """
@@ -250,80 +394,128 @@ class ConcurrentETHSiteIndexer:
 
     def __indexer(self):
         """
-        Function executed by a worker thread. If the to_download queue is empty for 10s,
-        the worker kills itself.
+        Function executed by a worker thread. The worker exits once it dequeues the STOP sentinel.
         For every target in the queue, it calls the __sub_index func.
 
         WARNING: This function is a member function of the same object. As a result it has access to the queues.
         HOWEVER, it can create data-races so DO NOT ACCESS ANYTHING ELSE OTHER THAN THE QUEUES!
         :return:
         """
-        # after timeout of 10s the indexer subprocess kills itself
-        counter = 0
-        while counter < 10:
-            try:
-                # dequeue the next element
-                target = self.to_download_queue.get(block=False)
+        while True:
+            # dequeue the next element
+            target = self.to_download_queue.get()
+
+            # crawl is done, leave the sentinel for the other workers.
+            if target is STOP:
+                self.to_download_queue.put(STOP)
+                return
 
+            try:
                 # perform sub index task
                 self.__sub_index(target["url"], target["prefix"])
-
-                # reset timeout
-                counter = 0
-
-            # sleep and timeout if queue is empty
-            except Empty:
-                counter += 1
-                sleep(1)
+            except Exception:
+                # TODO: logger and debug shit
+                print(traceback.format_exc())
+                print(target)
+                self.found_url_queue.put({"url": target["url"], "failed": True})
+            finally:
+                # children of the target are scheduled by now, so the crawl is done once nothing is pending.
+                if self.tracker.done():
+                    self.finish()
 
     def sub_index(self, url: str, prefix: str):
         """
         Wrapper for __sub_index function. (Here to allow for multiprocessing) switch back in case you want to debug or
         test something, have here the self.__sub__index function
 
+        Urls that were already scheduled in this run are dropped.
+
         :param url: full url of sub site to index like https://www.video.ethz.ch/speakers/d-infk/2015.html
         :param prefix: prefix of the site, only searching urls with identical prefix, like /speakers/d-infk
         :return:
         """
+        if not self.visited.add_if_new(url):
+            return
+
+        self.tracker.add()
         self.to_download_queue.put({"url": url, "prefix": prefix})
 
-    def dequeue(self):
+    def dequeue(self, batch_size: int = 500, commit_interval: float = 2.0):
         """
         Function retrieves the urls from the video_url queue and writes them to the file specified in init.
-        Function exits after 10s of an empty queue or when all workers are done.
+        Function exits when it dequeues the STOP sentinel, which is put after the last result.
+
+        The results are written in batches, a batch is committed once it holds batch_size results or commit_interval
+        seconds passed since the last commit.
+
+        :param batch_size: maximum number of results written in one transaction
+        :param commit_interval: maximum number of seconds a result waits in the batch
         :return:
         """
-        # Timeout to prevent endless loop if a subprocesses crash
-        insert_counter = 0
-        counter = 0
-        while counter < 10 and self.workers_alive():
-            if not self.found_url_queue.empty():
-                while not self.found_url_queue.empty():
-                    arguments = self.found_url_queue.get()
-                    url = arguments["url"]
-                    a_video = arguments["is_video"]
-
-                    try:
-                        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        if self.not_in_db(url):
-                            self.sq_cur.execute("INSERT INTO sites (URL, IS_VIDEO, found) VALUES "
-                                                f"('{url}', {a_video}, '{now}')")
-                            self.sq_con.commit()
-                            insert_counter += 1
-                        else:
-                            # TODO: logger and debug shit
-                            print("Already in db")
-
-                    except sqlite3.IntegrityError:
-                        # TODO: logger and debug shit
-                        print(traceback.format_exc())
-                        print(arguments)
-                    counter = 0
-            else:
-                counter += 1
-                sleep(1)
+        sites_before = self.db.count_sites()
+
+        batch = []
+        last_commit = monotonic()
+
+        while True:
+            try:
+                res = self.found_url_queue.get(timeout=commit_interval)
+
+                # the last target is done and all results are dequeued.
+                if res is STOP:
+                    break
+
+                batch.append(res)
+
+            # nothing new, but the pending batch may be due.
+            except Empty:
+                pass
+
+            if len(batch) >= batch_size or (len(batch) > 0 and monotonic() - last_commit >= commit_interval):
+                self.write_batch(batch)
+                batch = []
+                last_commit = monotonic()
+
+        self.write_batch(batch)
+
         # TODO: logger and debug shit
-        print(f"Inserted {insert_counter} entries in sites table")
+        print(f"Inserted {self.db.count_sites() - sites_before} entries in sites table")
+        print(get_transport().bytes.report("index"))
+
+    def write_batch(self, batch: list):
+        """
+        Writes a batch of results from the found_url_queue in a single transaction. New sites are inserted, sites
+        already in the database get their last seen time (and validators) updated. Failed sites are flagged and stay
+        unfinished in the work state.
+
+        :param batch: list of result dicts like they are put in the found_url_queue
+        :return:
+        """
+        if len(batch) == 0:
+            return
+
+        timestamp = now()
+        failed = [res["url"] for res in batch if res.get("failed")]
+        seen = [res["url"] for res in batch if res.get("not_modified")]
+        found = [(res["url"], res["is_video"], res.get("etag"), res.get("last_modified"))
+                 for res in batch if not res.get("not_modified") and not res.get("failed")]
+
+        try:
+            with self.db.transaction():
+                self.db.touch_sites(seen, timestamp)
+                self.db.upsert_sites(found, timestamp)
+                self.db.fail_sites(failed, timestamp)
+
+                # checkpoint, children are pending until their own result is written.
+                self.work_state.add_pending([child for res in batch for child in res.get("children", [])])
+                self.work_state.mark_done([res["url"] for res in batch if not res.get("failed")])
+        except sqlite3.IntegrityError:
+            # TODO: logger and debug shit
+            print(traceback.format_exc())
+            print(batch)
+
+        # TODO: logger and debug shit
+        print(f"Wrote {len(batch)} sites")
 
     def not_in_db(self, url):
         """
@@ -331,43 +523,33 @@ class ConcurrentETHSiteIndexer:
         :param url:
         :return:
         """
-        self.sq_cur.execute(f"SELECT key FROM sites WHERE URL = '{url}'")
-        return self.sq_cur.fetchone() is None
+        return self.db.site_key(url) == -1
 
-    def gen_parent(self):
+    def update_found(self, url: str):
         """
-        Generates the tree hierarchy for the site index.
+        Update the found entry of a given row to the current date and time.
+
+        :param url: url to match for the update for the last seen time.
         :return:
         """
-        # temporary storage of parent url:key to parent_id:value.
-        parent_ids = {}
-
-        self.sq_cur.execute("SELECT key, URL FROM sites WHERE parent IS NULL")
-        one = self.sq_cur.fetchone()
-
-        # perform the parent linking while there are entries that have no parent.
-        while one is not None:
-            key = one[0]
-            url = one[1]
-
-            # generate the parent url from own url.
-            parent_url = parent_site(url)
+        self.db.touch_sites([url])
 
-            # try to locate the parent_id in the temporary dictionary.
-            parent_id = parent_ids.get(parent_url)
-
-            # if no id is found, search the id and put it in the temp dict.
-            if parent_id is None:
-                parent_id = self.get_url_id(parent_url)
-                parent_ids[parent_url] = parent_id
+    def gen_parent(self):
+        """
+        Generates the tree hierarchy for the site index. Sites are already linked to their parent when they are
+        written, this links the remaining ones (parent written after the child, or databases of older versions).
+        Sites whose parent isn't in the index get the parent -1.
+        :return:
+        """
+        # key of every url, so the parents can be resolved without a query per site.
+        keys = self.db.site_keys()
+        updates = [(keys.get(parent_site(url), -1), key) for key, url in self.db.unlinked_sites()]
 
-            # TODO: logging and debug shit
-            print(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
-            self.sq_cur.execute(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
+        with self.db.transaction():
+            self.db.set_parents(updates)
 
-            # Fetch the next entry which has no parent.
-            self.sq_cur.execute("SELECT key, URL FROM sites WHERE parent IS NULL")
-            one = self.sq_cur.fetchone()
+        # TODO: logging and debug shit
+        print(f"Linked {len(updates)} sites to their parent")
 
     def get_url_id(self, url: str):
         """
@@ -376,13 +558,7 @@ class ConcurrentETHSiteIndexer:
         :param url: url to retrieve the key from.
         :return: key or -1 if no key found.
         """
-        self.sq_cur.execute(f"SELECT (key) FROM sites WHERE URL IS '{url}'")
-        query_result = self.sq_cur.fetchall()
-
-        if len(query_result) == 0 or len(query_result[0]) == 0:
-            return -1
-
-        return query_result[0][0]
+        return self.db.site_key(url)
 
     def workers_alive(self):
         """
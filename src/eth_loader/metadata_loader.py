@@ -1,15 +1,70 @@
+import datetime
 import multiprocessing as mp
 import os.path
-import queue
-import time
+import re
 import traceback
-import datetime
-import requests as rq
 import threading
-from sqlite3 import *
+from queue import Queue
+from time import monotonic
+
+from eth_loader.checkpoint import WorkState
+from eth_loader.database import ACTIVE, REACTIVATED, Database
+from eth_loader.documents import SeriesRecord, series_record
+from eth_loader.transport import configure_worker, get_transport, worker_settings
+from eth_loader.work_tracker import STOP
+
+# /category/subcategory/year/season/lecture_id.html
+SEMESTER = re.compile(r"/(\d{4})/(spring|autumn)/")
+
+
+def recent_semesters(today: datetime.date = None) -> set:
+    """
+    The current and the previous semester. The spring semester runs from february to july, the autumn semester from
+    august to january.
+
+    :param today: date to compute the semesters for, defaults to today
+    :return: set of tuples (year, season) like ("2022", "spring")
+    """
+    today = datetime.date.today() if today is None else today
+
+    if today.month >= 8:
+        return {(str(today.year), "autumn"), (str(today.year), "spring")}
+
+    if today.month >= 2:
+        return {(str(today.year), "spring"), (str(today.year - 1), "autumn")}
+
+    return {(str(today.year - 1), "autumn"), (str(today.year - 1), "spring")}
+
+
+def needs_refresh(site: tuple, semesters: set, stale: str) -> bool:
+    """
+    Decides if the metadata of a series needs to be downloaded again in an incremental run. That's the case for
+    series without metadata, series whose site changed since the metadata was last seen, series of the given
+    semesters and series whose metadata wasn't seen since stale.
+
+    :param site: tuple (key, URL, etag, last_modified, changed, last_seen) as returned by Database.video_sites
+    :param semesters: set of (year, season) to always refresh, see recent_semesters
+    :param stale: timestamp, metadata last seen before it is refreshed
+    :return:
+    """
+    changed, last_seen = site[4], site[5]
 
+    # new series or legacy metadata without last_seen
+    if last_seen is None:
+        return True
 
-def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_id: int = -1) -> dict:
+    if changed is not None and changed > last_seen:
+        return True
+
+    match = SEMESTER.search(site[1])
+    if match is not None and (match.group(1), match.group(2)) in semesters:
+        return True
+
+    return last_seen < stale
+
+
+def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_id: int = -1, etag: str = None,
+                      last_modified: str = None) -> SeriesRecord:
     """
     Function to download a single metadata file for a given video_site. The website_url needs to be of type:
 
@@ -26,16 +81,29 @@ def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_i
     :param identifier: str for thread to give i/home/alisot2000/Documents/01 ReposNCode/ETH-Lecture-Loadernformation
     where the download was executed in case of an error.
     :param headers: dict to be passed to the request library. Download will fail if no user-agent is provided.
+    :param parent_id: key of the site in the sites table
+    :param etag: ETag of the stored metadata, sent as If-None-Match
+    :param last_modified: Last-Modified of the stored metadata, sent as If-Modified-Since
+    :return: record with the parsed and compressed document, see documents.py
     """
 
     url = website_url.replace(".html", ".series-metadata.json").replace("\n", "")
 
-    result = rq.get(url=url, headers=headers)
+    # conditional request, the server answers with 304 if the stored metadata is still up to date.
+    headers = dict(headers)
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+
+    result = get_transport().get(url, headers=headers, stage="metadata")
     content = None
     # https://www.asdf.com/path?args
 
     if result.ok:
-        content = result.content.decode("utf-8")
+        content = result.content
+    elif result.status_code == 304:
+        pass
     else:
         print(f"{identifier:.02} error {result.status_code}")
 
@@ -46,41 +114,56 @@ def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_i
     path = path.split("?")[0]
     print(f"{identifier} Done {url}")
 
-    return {"url": url, "parent_id": parent_id, "status": result.status_code, "content": content}
+    # parsed here instead of in the writer, which only stores the record.
+    return series_record(url=url, site_url=website_url, parent_id=parent_id, status=result.status_code, raw=content,
+                         etag=result.headers.get("ETag"), last_modified=result.headers.get("Last-Modified"))
 
 
-def handler(worker_nr: int, command_queue: mp.Queue, result_queue: mp.Queue):
+def handler(worker_nr: int, command_queue: Queue, result_queue: Queue, settings: dict = None):
     """
-    Function executed in a worker thread. The function tries to download the given url in the queue. If the queue is
-    empty for 20s, it will kill itself.
+    Function executed in a worker thread (or process). The function tries to download the given url in the queue. It
+    exits when it dequeues the STOP sentinel and puts a STOP sentinel in the result queue, so the writer knows it is
+    done.
 
     :param worker_nr: Itendifier for debugging
     :param command_queue: Queue containing dictionaries containing all relevant information for downloading
     :param result_queue: Queue to put the results in. Handled in main thread.
+    :param settings: transport settings of the parent (worker_settings), only passed to worker processes
     :return:
     """
     print("Starting")
-    ctr = 0
-    while ctr < 20:
-        try:
-            arguments = command_queue.get(block=False)
-            ctr = 0
-        except queue.Empty:
-            ctr += 1
-            time.sleep(1)
-            continue
-
-        result = retrieve_metadata(arguments["url"], str(worker_nr),
-                                   headers={"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) "
-                                                          "Gecko/20100101 Firefox/100.0"},
-                                   parent_id=arguments["parent_id"])
-
-        result_queue.put(result)
-    print(f"{worker_nr} Terminated")
+    try:
+        # inside the try, a worker failing to configure still puts its STOP sentinel
+        if settings is not None:
+            configure_worker(settings)
+
+        while True:
+            arguments = command_queue.get()
+
+            if arguments is STOP:
+                break
+
+            try:
+                result = retrieve_metadata(arguments["url"], str(worker_nr),
+                                           headers={"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) "
+                                                                  "Gecko/20100101 Firefox/100.0"},
+                                           parent_id=arguments["parent_id"], etag=arguments["etag"],
+                                           last_modified=arguments["last_modified"])
+            except Exception:
+                # TODO: logger and debug shit
+                print(traceback.format_exc())
+                result = SeriesRecord(url=arguments["url"], site_url=arguments["url"],
+                                      parent_id=arguments["parent_id"], status=-1)
+
+            result_queue.put(result)
+    finally:
+        result_queue.put(STOP)
+        print(f"{worker_nr} Terminated")
 
 
 class EpisodeLoader:
-    def __init__(self, index_db: str):
+    def __init__(self, index_db: str, incremental: bool = False, ttl_days: float = 30.0, queue_size: int = 256,
+                 processes: bool = False):
         """
         Initialise downloader function. Provide the function either with a file containing valid urls or a list of urls.
 
@@ -92,47 +175,68 @@ class EpisodeLoader:
 
 
         :param index_db: Database result of the indexer.
+        :param incremental: only download the series which might have changed, see needs_refresh
+        :param ttl_days: in incremental mode, metadata not seen for that many days is downloaded again
+        :param queue_size: capacity of the command and the result queue, workers block while the writer is behind
+        :param processes: run the workers in processes instead of threads, see spawn
         """
 
         self.db_path = os.path.abspath(index_db)
 
-        self.sq_con = Connection(self.db_path)
-        self.sq_cur = self.sq_con.cursor()
+        # written by the writer thread, see start_writer
+        self.db = Database(self.db_path, check_same_thread=False)
 
-        self.result_queue = mp.Queue()
-        self.command_queue = mp.Queue()
+        # bounded, so only queue_size results are held in memory at any time. Threads share in process queues, only
+        # worker processes need the pickling and pipes of a mp.Queue.
+        self.processes = processes
+        if processes:
+            self.context = mp.get_context("spawn")
+            self.result_queue = self.context.Queue(maxsize=queue_size)
+            self.command_queue = self.context.Queue(maxsize=queue_size)
+        else:
+            self.context = None
+            self.result_queue = Queue(maxsize=queue_size)
+            self.command_queue = Queue(maxsize=queue_size)
         self.urls = []
         self.nod = 0
 
-        self.workers = None
+        self.incremental = incremental
+        self.ttl_days = ttl_days
+
+        self.workers = []
+        self.writer = None
 
         self.genera_cookie = None
 
-        self.get_video_urls()
         self.check_results_table()
+        self.get_video_urls()
+
+        self.work_state = WorkState(self.db.con, "metadata")
 
     def get_video_urls(self):
         self.verify_args_table()
-        self.sq_cur.execute("SELECT key, url FROM sites WHERE IS_VIDEO=1")
-        self.urls = self.sq_cur.fetchall()
+        # validators of the latest active metadata entry of each site, NULL if the site wasn't downloaded yet.
+        self.urls = self.db.video_sites()
 
-    def verify_args_table(self):
-        self.sq_cur.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name='sites'")
+        if self.incremental:
+            stale = (datetime.datetime.now() - datetime.timedelta(days=self.ttl_days)).strftime("%Y-%m-%d %H:%M:%S")
+            semesters = recent_semesters()
 
-        if self.sq_cur.fetchone() is None:
+            total = len(self.urls)
+            self.urls = [site for site in self.urls if needs_refresh(site, semesters, stale)]
+
+            # TODO: logger and debug shit
+            print(f"Incremental run, refreshing {len(self.urls)} of {total} series")
+
+    def verify_args_table(self):
+        if not self.db.table_exists("sites"):
             raise ValueError("didn't find the 'sites' table inside the given database.")
 
-    def check_results_table(self):
-        self.sq_cur.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name='metadata'")
+        # sites written by an older indexer lack the columns video_sites selects
+        self.db.create_sites()
 
-        if self.sq_cur.fetchone() is None:
-            self.sq_cur.execute("CREATE TABLE metadata "
-                                "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
-                                "parent INTEGER, "
-                                "URL TEXT , "
-                                "json TEXT,"
-                                "deprecated INTEGER DEFAULT 0 CHECK (metadata.deprecated >= 0 AND metadata.deprecated <= 1),"
-                                "found TEXT)")
+    def check_results_table(self):
+        self.db.create_metadata()
 
     def cleanup(self):
         """
@@ -141,9 +245,9 @@ class EpisodeLoader:
         """
         for worker in self.workers:
             worker: threading.Thread
-            worker.join(10)
+            worker.join()
 
-    def download(self, workers: int = 100):
+    def download(self, workers: int = 100, resume: bool = False):
         """
         Initiate main Download of the urls provided in the init method.
         Calls the enqueue function and then the check_result function.
@@ -152,107 +256,177 @@ class EpisodeLoader:
         or the entire metadata is stored inside the target file. **WARNING the target file WILL be overwritten**
 
         :param workers: number of worker threads to run concurrently
+        :param resume: only download the sites the previous run didn't finish, full run if there is none
         :return:series
         """
-        self.enqueue_th(workers)
-        self.check_result()
-        self.cleanup()
-        self.sq_con.commit()
+        try:
+            self.enqueue_th(workers, resume)
+        finally:
+            self.writer.join()
+            self.cleanup()
+
+        self.db.commit()
+        print(get_transport().bytes.report("metadata"))
         print("DOWNLOAD DONE")
 
+    def start_writer(self):
+        """
+        Starts the thread storing the results (check_result). It's the only thread using the database until it is
+        joined, so the results are drained while the commands are still being enqueued.
+        :return:
+        """
+        self.writer = threading.Thread(target=self.check_result)
+        self.writer.start()
+
     def spawn(self, workers: int):
-        # generate arguments for the worker threads
-        commands = [(i, self.command_queue, self.result_queue,) for i in range(workers)]
-        threads = []
+        """
+        Spawns the workers, threads by default. Worker processes are started with the spawn method, so the script
+        needs an if __name__ == "__main__" guard. Each process configures its own transport like the one of the parent,
+        the rate limits are split evenly between the processes (see worker_settings). The byte counters of the
+        processes aren't reported.
+
+        :param workers: number of workers
+        :return:
+        """
+        # generate arguments for the worker threads, processes additionally get the settings of the transport
+        settings = (worker_settings(workers),) if self.processes else ()
+        commands = [(i, self.command_queue, self.result_queue, *settings) for i in range(workers)]
 
-        # spawn threads
+        # spawn threads, every started worker is listed right away so it gets its STOP sentinel if spawning fails
+        self.workers = []
         for command in commands:
-            t = threading.Thread(target=handler, args=command)
+            if self.processes:
+                t = self.context.Process(target=handler, args=command)
+            else:
+                t = threading.Thread(target=handler, args=command)
             t.start()
-            threads.append(t)
+            self.workers.append(t)
 
-        self.workers = threads
-
-    def enqueue_th(self, workers):
+    def enqueue_th(self, workers, resume: bool = False):
         """
-        Function to load the urls and put them inside a queue for the workers to download them. Also spawns the worker threads.
+        Function to load the urls and put them inside a queue for the workers to download them. Also spawns the worker
+        threads and the writer. Blocks while the command queue is full. The STOP sentinels are put and the writer is
+        started even if it fails, so the caller can join them.
 
         :param workers: number of workers. At least 1 maybe at most 10'000
+        :param resume: skip the urls the previous run finished
         :return:
         """
 
-        self.spawn(workers)
+        try:
+            self.spawn(workers)
+            self.enqueue_urls(resume)
+        finally:
+            # one sentinel per worker, behind all the urls.
+            for _ in range(len(self.workers)):
+                self.command_queue.put(STOP)
+
+            # the writer drains the STOP sentinels of the workers, even if the enqueueing failed before it started
+            if self.writer is None:
+                self.start_writer()
+
+    def enqueue_urls(self, resume: bool = False):
+        """
+        Puts the urls in the command queue and starts the writer once the work state is checkpointed.
 
+        :param resume: skip the urls the previous run finished
+        :return:
+        """
         if self.urls is not None:
-            self.nod = len(self.urls)
-            for url in self.urls:
-                self.command_queue.put({"url": url[1], "parent_id": url[0]})
+            urls = self.urls
+
+            if resume and self.work_state.has_run():
+                done = self.work_state.done()
+                urls = [url for url in self.urls if url[1] not in done]
+                print(f"Resuming with {len(urls)} of {len(self.urls)} sites")
+            else:
+                self.work_state.reset()
+                self.work_state.add_pending([(url[1], None) for url in urls])
+
+            self.nod = len(urls)
+            self.work_state.mark_in_flight([url[1] for url in urls])
+            self.db.commit()
+
+            self.start_writer()
+            for url in urls:
+                self.command_queue.put({"url": url[1], "parent_id": url[0], "etag": url[2], "last_modified": url[3]})
         else:
             raise ValueError("Database apparently doesn't have any urls, get_urls retrieved None")
 
-    def check_result(self):
+    def check_result(self, commit_interval: float = 5.0):
         """
         Function check the results in the results queue.
 
         Either choose multi_file, then the target_dir is also evaluated and the site structure is stored inside the dir
         or the entire metadata is stored inside the target file. **WARNING the target file WILL be overwritten**
+
+        :param commit_interval: seconds between commits, the results and work state are checkpointed with each commit
         :return:
         """
         g_counter = 0
         e_counter = 0
-
-        ctr = 0
-        while ctr < 20:
-            if not self.result_queue.empty():
-                try:
-                    res = self.result_queue.get()
-                    parent_id = res["parent_id"]
-                    url = res["url"]
-                    content = res["content"].replace("'", "''")
-
-                    if res["status"] == 200:
-                        self.insert_update_db(parent_id=parent_id, url=url, json=content)
-                    else:
-                        print(f"Failed to download {url} with status code {res['status']}")
-                        e_counter += 1
-                    ctr = 0
-                except Exception as e:
-                    print(traceback.format_exc())
-                    print(f"\n\n\n FUCKING EXCEPTION {e}\n\n\n")
-                    print(res["url"])
-                    print(res["content"])
+        last_commit = monotonic()
+
+        # every worker puts a STOP sentinel when it exits, the last result is in once all of them arrived.
+        running = len(self.workers)
+        while running > 0:
+            res = self.result_queue.get()
+
+            if res is STOP:
+                running -= 1
+                continue
+
+            res: SeriesRecord
+            try:
+                if res.status == 200:
+                    self.insert_update_db(res)
+
+                # unchanged since the last run, no need to compare it with the db.
+                elif res.status == 304:
+                    self.update_seen(parent_id=res.parent_id, url=res.url)
+
+                # failed downloads stay unfinished, a resumed run retries them.
+                if res.status in (200, 304):
+                    self.work_state.mark_done([res.site_url])
+                else:
+                    print(f"Failed to download {res.url} with status code {res.status}")
                     e_counter += 1
-                g_counter += 1
-            else:
-                time.sleep(1)
-                ctr += 1
+            except Exception as e:
+                print(traceback.format_exc())
+                print(f"\n\n\n FUCKING EXCEPTION {e}\n\n\n")
+                print(res.url)
+                e_counter += 1
+            g_counter += 1
+
+            if monotonic() - last_commit >= commit_interval:
+                self.db.commit()
+                last_commit = monotonic()
 
         print(f"Downloaded {g_counter} with {e_counter} errors.")
 
-    def insert_update_db(self, parent_id: int, url: str, json: str):
-        # exists:
-        self.sq_cur.execute(f"SELECT key FROM metadata WHERE parent = {parent_id} AND URL = '{url}' AND json = '{json}' AND deprecated = 0")
+    def update_seen(self, parent_id: int, url: str):
+        """
+        Sets the last seen time of the active metadata entries of the given site to now.
 
-        # it exists, abort
-        if self.sq_cur.fetchone() is not None:
-            print("Found active in db")
-            return
+        :param parent_id: key of the site in the sites table
+        :param url: url of the series-metadata.json
+        :return:
+        """
+        self.db.touch_metadata(parent_id, url)
 
-        # exists but is deprecated
-        self.sq_cur.execute(f"SELECT key FROM metadata WHERE parent = {parent_id} AND URL = '{url}' AND json = '{json}' AND deprecated = 1")
+    def insert_update_db(self, record: SeriesRecord):
+        """
+        Stores the downloaded metadata of a series, parsed and compressed by the worker.
 
-        result = self.sq_cur.fetchone()
-        if result is not None:
+        :param record: result of the worker with status 200
+        :return:
+        """
+        state = self.db.upsert_metadata(record.parent_id, record.url, record.payload, record.content_hash, record.etag,
+                                        record.last_modified, record.episodes)
 
+        if state == ACTIVE:
+            print("Found active in db")
+        elif state == REACTIVATED:
             print("Found inactive in db, reacivate and set everything else matching parent, url and series to deprecated")
-
-            # update all entries, to deprecated, unset deprecated where it is here
-            self.sq_cur.execute(f"UPDATE metadata SET deprecated = 1 WHERE parent = {parent_id} AND URL = {url}")
-            self.sq_cur.execute(f"UPDATE metadata SET deprecated = 0 WHERE key = {result}")
-            return
-
-        # doesn't exist -> insert
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print("Inserting")
-        self.sq_cur.execute(
-            f"INSERT INTO metadata (parent, URL, json, found) VALUES ({parent_id}, '{url}', '{json}', '{now}')")
+        else:
+            print("Inserting")
@@ -0,0 +1,180 @@
+"""
+# Schema migrations
+
+Every table group of the database has its own list of migrations, the version reached by a database is stored per
+group in the 'schema_version' table (see Database.migrate). A group is migrated when its stage opens the database,
+so the tables of a stage that never ran are not created.
+
+Migrations are (version, description, function(db)) and need to be idempotent: databases created before the
+schema_version table existed start at version 0 and run all migrations, whatever columns they already have.
+Only append new migrations, never change the ones already released.
+
+Backfills go through Database.batches, they hold one batch of rows in memory and commit after every batch. A backfill
+interrupted halfway continues where it stopped when the migration runs again.
+"""
+
+
+def _create_sites(db):
+    db.cur.execute("CREATE TABLE IF NOT EXISTS sites "
+                   "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "parent INTEGER, "
+                   "URL TEXT UNIQUE , "
+                   "IS_VIDEO INTEGER CHECK (IS_VIDEO >= 0 AND IS_VIDEO <= 1),"
+                   "found TEXT);")
+
+    # Dummy entry to have a root.
+    db.cur.execute("INSERT OR IGNORE INTO sites (key, parent, URL, IS_VIDEO, found) "
+                   "VALUES (0, -1, 'https://www.video.ethz.ch', 0, datetime('now', 'localtime'))")
+
+
+def _sites_last_seen(db):
+    db.ensure_column("sites", "last_seen", "TEXT")
+
+
+def _sites_validators(db):
+    db.ensure_column("sites", "etag", "TEXT")
+    db.ensure_column("sites", "last_modified", "TEXT")
+
+
+def _sites_indexes(db):
+    # URL is UNIQUE and therefore already indexed
+    db.cur.execute("CREATE INDEX IF NOT EXISTS sites_parent ON sites (parent)")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS sites_is_video ON sites (IS_VIDEO)")
+
+
+def _sites_changed(db):
+    db.ensure_column("sites", "changed", "TEXT")
+
+
+def _sites_failed(db):
+    db.ensure_column("sites", "failed", "INTEGER DEFAULT 0")
+
+
+def _create_metadata(db):
+    db.cur.execute("CREATE TABLE IF NOT EXISTS metadata "
+                   "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "parent INTEGER, "
+                   "URL TEXT , "
+                   "json BLOB,"
+                   "deprecated INTEGER DEFAULT 0 CHECK (metadata.deprecated >= 0 AND metadata.deprecated <= 1),"
+                   "found TEXT)")
+
+
+def _metadata_validators(db):
+    db.ensure_column("metadata", "last_seen", "TEXT")
+    db.ensure_column("metadata", "etag", "TEXT")
+    db.ensure_column("metadata", "last_modified", "TEXT")
+
+
+def _metadata_content_hash(db):
+    db.ensure_column("metadata", "content_hash", "TEXT")
+    db.backfill_content_hash("metadata")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS metadata_content_hash ON metadata (parent, URL, content_hash)")
+
+
+def _metadata_compress(db):
+    # TODO: logger and debug shit
+    print(f"Compressed {db.compress_payloads('metadata')} legacy metadata documents")
+
+
+def _metadata_indexes(db):
+    db.cur.execute("CREATE INDEX IF NOT EXISTS metadata_url ON metadata (URL)")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS metadata_parent ON metadata (parent, deprecated)")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS metadata_deprecated ON metadata (deprecated)")
+
+
+def _metadata_episodes(db):
+    db.ensure_column("metadata", "episodes", "TEXT")
+    db.backfill_episodes()
+
+
+def _create_episodes(db):
+    db.cur.execute("CREATE TABLE IF NOT EXISTS episodes "
+                   "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "parent INTEGER, "
+                   "URL TEXT , "
+                   "json BLOB,"
+                   "deprecated INTEGER DEFAULT 0 CHECK (episodes.deprecated >= 0 AND episodes.deprecated <= 1),"
+                   "found TEXT,"
+                   "streams TEXT)")
+
+
+def _episodes_content_hash(db):
+    db.ensure_column("episodes", "content_hash", "TEXT")
+    db.backfill_content_hash("episodes")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS episodes_content_hash ON episodes (parent, URL, content_hash)")
+
+
+def _episodes_compress(db):
+    # TODO: logger and debug shit
+    print(f"Compressed {db.compress_payloads('episodes')} legacy episode documents")
+
+
+def _episodes_indexes(db):
+    db.cur.execute("CREATE INDEX IF NOT EXISTS episodes_url ON episodes (URL)")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS episodes_parent ON episodes (parent, deprecated)")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS episodes_deprecated ON episodes (deprecated)")
+
+
+def _episodes_flat_streams(db):
+    db.normalize_episode_streams()
+
+
+def _create_streams(db):
+    db.cur.execute("CREATE TABLE IF NOT EXISTS streams "
+                   "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "URL TEXT , "
+                   "resolution TEXT,"
+                   "deprecated INTEGER DEFAULT 0 CHECK (deprecated >= 0 AND deprecated <= 1),"
+                   "found TEXT)")
+
+    db.cur.execute("INSERT OR IGNORE INTO streams (key, URL, resolution, found) VALUES (-1, 'dummy', 'dummy', 'dummy')")
+
+
+def _streams_indexes(db):
+    db.cur.execute("CREATE INDEX IF NOT EXISTS streams_url_resolution ON streams (URL, resolution, deprecated)")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS streams_deprecated ON streams (deprecated)")
+
+
+def _episode_streams(db):
+    # links episodes to their streams, the streams column of episodes only remains for the comparison of episodes
+    db.cur.execute("CREATE TABLE IF NOT EXISTS episode_streams "
+                   "(episode_key INTEGER NOT NULL, "
+                   "stream_key INTEGER NOT NULL, "
+                   "PRIMARY KEY (episode_key, stream_key)) WITHOUT ROWID")
+    db.cur.execute("CREATE INDEX IF NOT EXISTS episode_streams_stream ON episode_streams (stream_key)")
+    db.normalize_episode_streams()
+    db.backfill_episode_streams()
+
+
+SITES = [
+    (1, "create sites", _create_sites),
+    (2, "add last_seen", _sites_last_seen),
+    (3, "add etag and last_modified", _sites_validators),
+    (4, "index parent and IS_VIDEO", _sites_indexes),
+    (5, "add changed", _sites_changed),
+    (6, "add failed", _sites_failed),
+]
+
+METADATA = [
+    (1, "create metadata", _create_metadata),
+    (2, "add last_seen, etag and last_modified", _metadata_validators),
+    (3, "add content_hash", _metadata_content_hash),
+    (4, "compress json", _metadata_compress),
+    (5, "index URL, parent and deprecated", _metadata_indexes),
+    (6, "add episode ids", _metadata_episodes),
+]
+
+EPISODES = [
+    (1, "create episodes", _create_episodes),
+    (2, "add content_hash", _episodes_content_hash),
+    (3, "compress json", _episodes_compress),
+    (4, "index URL, parent and deprecated", _episodes_indexes),
+    (5, "flatten the stream keys", _episodes_flat_streams),
+]
+
+STREAMS = [
+    (1, "create streams", _create_streams),
+    (2, "index (URL, resolution) and deprecated", _streams_indexes),
+    (3, "add episode_streams", _episode_streams),
+]
@@ -0,0 +1,72 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+# Compressed payloads
+
+The json documents in metadata.json and episodes.json are stored as compressed BLOBs. The first byte of the BLOB names
+the codec, so rows written with different codecs can live in the same column:
+
+- b"z": zlib, always available
+- b"s": zstandard, used by default if the zstandard package is installed
+
+Rows written by older versions are TEXT, decode returns them unchanged. Readers should always go through decode.
+"""
+
+ZLIB = b"z"
+ZSTD = b"s"
+
+DEFAULT_CODEC = ZLIB if zstandard is None else ZSTD
+
+
+def encode(document: str, codec: bytes = None, level: int = None) -> bytes:
+    """
+    Compresses a document for storage.
+
+    :param document: json document, str or its utf-8 bytes
+    :param codec: ZLIB or ZSTD, defaults to DEFAULT_CODEC
+    :param level: compression level of the codec, None for its default
+    :return: codec byte followed by the compressed utf-8 of the document
+    """
+    codec = DEFAULT_CODEC if codec is None else codec
+    raw = document if isinstance(document, bytes) else document.encode("utf-8")
+
+    if codec == ZLIB:
+        return ZLIB + zlib.compress(raw, 6 if level is None else level)
+
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("The zstandard package is required for the zstd codec")
+
+        return ZSTD + zstandard.ZstdCompressor(level=3 if level is None else level).compress(raw)
+
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def decode(value) -> str:
+    """
+    Decompresses a stored document.
+
+    :param value: BLOB written by encode, TEXT of a legacy row or None
+    :return: the json document, None for None
+    """
+    if value is None or isinstance(value, str):
+        return value
+
+    value = bytes(value)
+    codec, data = value[:1], value[1:]
+
+    if codec == ZLIB:
+        return zlib.decompress(data).decode("utf-8")
+
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("The zstandard package is required to read zstd compressed rows")
+
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+
+    raise ValueError(f"Unknown codec {codec!r}")
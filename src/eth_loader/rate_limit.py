@@ -0,0 +1,156 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+"""
+# Rate limiting
+
+video.ethz.ch throttles clients that burst. The HostRateLimiter keeps one token bucket per host for requests and,
+optionally, one for bytes. All fetchers going through the shared Transport consult it before every request (and for
+every chunk of a streamed download), so the request rate stays just below the throttle point of the server. The
+asyncio indexer shares the limiter through reserve_request / reserve_bytes and sleeps on the event loop instead.
+"""
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket. Tokens are reserved up front, a caller asking for more tokens than available waits until
+    its reservation is covered, so concurrent callers are served in the order they asked.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        """
+        :param rate: tokens added per second
+        :param burst: maximum number of tokens stored
+        """
+        if rate <= 0:
+            raise ValueError("rate needs to be positive")
+
+        if burst <= 0:
+            raise ValueError("burst needs to be positive")
+
+        self.rate = rate
+        self.burst = burst
+
+        self.__tokens = float(burst)
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        Takes the tokens from the bucket, the bucket may go into debt.
+
+        :param amount: number of tokens to take
+        :return: seconds the caller needs to wait before using the tokens
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+
+            self.__tokens -= amount
+
+            if self.__tokens >= 0:
+                return 0.0
+
+            return -self.__tokens / self.rate
+
+    def acquire(self, amount: float = 1.0):
+        """
+        Blocks until the given number of tokens is available.
+
+        :param amount: number of tokens to take
+        :return:
+        """
+        wait = self.reserve(amount)
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """
+    Token buckets per host, for the request rate and optionally the transferred bytes.
+    """
+
+    def __init__(self, requests_per_second: float = 10.0, burst: float = 10.0, bytes_per_second: float = None,
+                 byte_burst: float = None):
+        """
+        :param requests_per_second: sustained requests per second and host
+        :param burst: number of requests that may be sent at once after an idle period
+        :param bytes_per_second: sustained bytes per second and host, None for no byte budget
+        :param byte_burst: bytes that may be transferred at once, defaults to one second worth of bytes
+        """
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.bytes_per_second = bytes_per_second
+        self.byte_burst = bytes_per_second if byte_burst is None else byte_burst
+
+        self.__request_buckets = {}
+        self.__byte_buckets = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def host(url: str) -> str:
+        """
+        Host part of the url, the key of the buckets.
+        """
+        return urlparse(url).netloc
+
+    def __bucket(self, buckets: dict, host: str, rate: float, burst: float) -> TokenBucket:
+        with self.__lock:
+            bucket = buckets.get(host)
+
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+                buckets[host] = bucket
+
+            return bucket
+
+    def reserve_request(self, url: str) -> float:
+        """
+        Takes a request token of the host of the url without blocking, for callers which can't block (asyncio).
+
+        :param url: url that is going to be requested
+        :return: seconds the caller needs to wait before sending the request
+        """
+        return self.__bucket(self.__request_buckets, self.host(url), self.requests_per_second, self.burst).reserve()
+
+    def reserve_bytes(self, url: str, amount: int) -> float:
+        """
+        Takes the given amount from the byte budget of the host without blocking, see reserve_request.
+
+        :param url: url the bytes were received from
+        :param amount: number of bytes received
+        :return: seconds the caller needs to wait before continuing, 0 without a byte budget
+        """
+        if self.bytes_per_second is None or amount <= 0:
+            return 0.0
+
+        return self.__bucket(self.__byte_buckets, self.host(url), self.bytes_per_second,
+                             self.byte_burst).reserve(amount)
+
+    def wait_request(self, url: str):
+        """
+        Blocks until a request to the host of the url may be sent.
+
+        :param url: url that is going to be requested
+        :return:
+        """
+        wait = self.reserve_request(url)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def wait_bytes(self, url: str, amount: int):
+        """
+        Blocks until the byte budget of the host covers the given amount. No-op without a byte budget.
+
+        :param url: url the bytes were received from
+        :param amount: number of bytes received
+        :return:
+        """
+        wait = self.reserve_bytes(url, amount)
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,197 @@
+import random
+import threading
+from time import monotonic
+from urllib.parse import urlparse
+
+import requests as rq
+
+"""
+# Retries and circuit breaking
+
+A failed fetch used to drop its url until the next full run. The Transport now retries with a RetryPolicy:
+
+- retryable: connection errors, timeouts and the statuses in RETRY_STATUSES (throttling and server side errors)
+- permanent: every other status (404, 403, ...) and every other exception, those are returned / raised immediately
+
+Between attempts the policy waits a random time between 0 and base_delay * 2 ** attempt, capped at max_delay
+(exponential backoff with full jitter), so the workers don't retry in lockstep. A Retry-After header of the server
+takes precedence.
+
+Every host has a CircuitBreaker. After failure_threshold retryable failures in a row it opens and all workers
+requesting from the host block until reset_timeout passed. Then a single probe request is let through, if it succeeds
+the breaker closes again and the workers continue, otherwise it stays open for another reset_timeout.
+"""
+
+RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class RetryPolicy:
+    """
+    Classifies failures and computes the backoff between attempts.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 retry_statuses: frozenset = RETRY_STATUSES):
+        """
+        :param max_attempts: number of attempts per request including the first one, 1 disables retries
+        :param base_delay: seconds of the backoff after the first attempt
+        :param max_delay: upper bound of the backoff in seconds
+        :param retry_statuses: http statuses worth retrying
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts needs to be at least 1")
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+    def is_retryable_status(self, status: int) -> bool:
+        """
+        Checks if a response with the given status should be retried.
+        """
+        return status in self.retry_statuses
+
+    @staticmethod
+    def is_retryable_error(error: Exception) -> bool:
+        """
+        Checks if a request failing with the given exception should be retried.
+        """
+        return isinstance(error, (rq.ConnectionError, rq.Timeout))
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        """
+        Seconds to wait before the next attempt.
+
+        :param attempt: number of the failed attempt, starting at 0
+        :param retry_after: value of the Retry-After header of the response, if any
+        :return:
+        """
+        if retry_after is not None:
+            try:
+                return min(self.max_delay, max(0.0, float(retry_after)))
+            except ValueError:
+                # http date instead of seconds, fall back to the backoff
+                pass
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker of a single host.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param failure_threshold: retryable failures in a row that open the breaker
+        :param reset_timeout: seconds the breaker stays open before a probe is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self.failures = 0
+
+        self.__opened = 0.0
+        self.__probing = False
+        self.__cond = threading.Condition()
+
+    def wait(self):
+        """
+        Blocks while the breaker is open. Once the reset timeout passed, exactly one caller is let through as a probe,
+        the others wait for its outcome.
+        :return:
+        """
+        with self.__cond:
+            while True:
+                if self.state == CLOSED:
+                    return
+
+                if self.state == OPEN:
+                    remaining = self.__opened + self.reset_timeout - monotonic()
+
+                    if remaining <= 0:
+                        self.state = HALF_OPEN
+                        self.__probing = True
+                        return
+
+                    self.__cond.wait(remaining)
+                    continue
+
+                # half open, wait for the probe unless it got lost
+                if not self.__probing:
+                    self.__probing = True
+                    return
+
+                self.__cond.wait()
+
+    def record_success(self):
+        """
+        Reports a request that reached the host, closes the breaker.
+        :return:
+        """
+        with self.__cond:
+            self.failures = 0
+            self.__probing = False
+
+            if self.state != CLOSED:
+                self.state = CLOSED
+
+                # TODO: logging and debug shit
+                print("Circuit closed, resuming requests")
+                self.__cond.notify_all()
+
+    def record_failure(self):
+        """
+        Reports a retryable failure, opens the breaker after too many of them or if the probe failed.
+        :return:
+        """
+        with self.__cond:
+            self.failures += 1
+            self.__probing = False
+
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.__opened = monotonic()
+
+                # TODO: logging and debug shit
+                print(f"Circuit opened after {self.failures} failures, pausing requests for {self.reset_timeout}s")
+
+            self.__cond.notify_all()
+
+
+class CircuitBreakers:
+    """
+    One CircuitBreaker per host.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param failure_threshold: retryable failures in a row that open the breaker of a host
+        :param reset_timeout: seconds a breaker stays open before a probe is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.__breakers = {}
+        self.__lock = threading.Lock()
+
+    def get(self, url: str) -> CircuitBreaker:
+        """
+        Returns the breaker of the host of the url, creates it on first use.
+        """
+        host = urlparse(url).netloc
+
+        with self.__lock:
+            breaker = self.__breakers.get(host)
+
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.__breakers[host] = breaker
+
+            return breaker
@@ -1,16 +1,14 @@
-import datetime
-import os.path
 import sqlite3
 
 import traceback
-import requests as rq
 from lxml import etree
 from lxml.etree import _Element
-import multiprocessing as mp
 from threading import Thread
 from time import sleep
-from queue import Empty
-from sqlite3 import *
+from queue import Empty, Queue
+
+from eth_loader.database import Database, parent_site
+from eth_loader.transport import get_transport
 
 """
 # Functionality of Class:
@@ -33,23 +31,6 @@ from sqlite3 import *
 """
 
 
-def parent_site(url: str) -> str:
-    """
-    Generates the url to the parent site.
-    :param url: url to get the parent of.
-    :return:
-    """
-    snippets = url.split("/")
-    del snippets[-1]
-
-    url = snippets[0]
-    for i in range(1, len(snippets)):
-        url += "/" + snippets[i]
-
-    url += ".html"
-    return url
-
-
 def is_video(root: _Element) -> bool:
     """
     Checks if the video is present on the video.
@@ -82,16 +63,13 @@ class ConcurrentETHSiteIndexer:
         """
         self.prefixes = ["/campus", "/conferences", "/events", "/speakers", "/lectures"]
         self.file = file
-        make_db = not os.path.exists(file)
 
-        self.sq_con = Connection(file)
-        self.sq_cur = self.sq_con.cursor()
+        self.db = Database(file)
+        self.db.create_sites()
 
-        if make_db:
-            self.init_db()
-
-        self.to_download_queue = mp.Queue()
-        self.found_url_queue = mp.Queue(maxsize=100)
+        # only threads of this process use the queues, no need for the pickling and pipes of mp.Queue
+        self.to_download_queue = Queue()
+        self.found_url_queue = Queue(maxsize=100)
         self.threads = []
 
     def val_uri(self, url: str) -> bool:
@@ -115,33 +93,14 @@ class ConcurrentETHSiteIndexer:
 
         return False
 
-    def init_db(self):
-        """
-        Initialises the database.
-        :return:
-        """
-        self.sq_cur.execute("CREATE TABLE sites "
-                            "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
-                            "parent INTEGER, "
-                            "URL TEXT UNIQUE , "
-                            "IS_VIDEO INTEGER CHECK (IS_VIDEO >= 0 AND IS_VIDEO <= 1),"
-                            "found TEXT,"
-                            "last_seen TEXT);")  # found now is equivalent to 'last seen'
-
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Dummy entry to have a root.
-        self.sq_cur.execute(
-            f"INSERT INTO sites (key, parent, URL, IS_VIDEO, found, last_seen) VALUES (0, -1, 'https://www.video.ethz.ch', 0, '{now}', '{now}')")
-        print("Table Created")
-
     def index_video_eth(self):
         """
         Starts the indexing of the site.
         :return:
         """
         # load main site
-        resp = rq.get("https://www.video.ethz.ch/", headers={"user-agent": "Mozilla Firefox"})
+        resp = get_transport().get("https://www.video.ethz.ch/", headers={"user-agent": "Mozilla Firefox"},
+                                   stage="index")
 
         # get the html
         html = resp.content.decode("utf-8")
@@ -171,7 +130,7 @@ class ConcurrentETHSiteIndexer:
         # TODO: logger and debug shit
         print("Cleanup")
         self.cleanup()
-        self.sq_con.commit()
+        self.db.commit()
 
     def __sub_index(self, url: str, prefix: str):
         """
@@ -186,7 +145,7 @@ class ConcurrentETHSiteIndexer:
         :return:
         """
         # load target site
-        resp = rq.get(url, headers={"user-agent": "Mozilla Firefox"})
+        resp = get_transport().get(url, headers={"user-agent": "Mozilla Firefox"}, stage="index")
         # get the html
         html = resp.content.decode("utf-8")
 
@@ -307,15 +266,11 @@ class ConcurrentETHSiteIndexer:
                     a_video = arguments["is_video"]
 
                     try:
-                        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        if self.not_in_db(url):
-                            self.sq_cur.execute("INSERT INTO sites (URL, IS_VIDEO, found, last_seen) VALUES "
-                                                f"('{url}', {a_video}, '{now}', '{now}')")
-                            self.sq_con.commit()
+                        if self.db.upsert_site(url, a_video):
+                            self.db.commit()
                             insert_counter += 1
                             print(f"Found new: {url}")
                         else:
-                            self.update_found(url=url)
                             print(f"Already in DB: {url}")
                     except sqlite3.IntegrityError:
                         # TODO: logger and debug shit
@@ -334,8 +289,7 @@ class ConcurrentETHSiteIndexer:
         :param url:
         :return:
         """
-        self.sq_cur.execute(f"SELECT key FROM sites WHERE URL = '{url}'")
-        return self.sq_cur.fetchone() is None
+        return self.db.site_key(url) == -1
 
     def update_found(self, url: str):
         """
@@ -344,8 +298,7 @@ class ConcurrentETHSiteIndexer:
         :param url: url to match for the update for the last seen time.
         :return:
         """
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.sq_cur.execute(f"UPDATE sites SET last_seen = '{now}' WHERE URL IS '{url}'")
+        self.db.touch_sites([url])
 
     def gen_parent(self):
         """
@@ -355,13 +308,8 @@ class ConcurrentETHSiteIndexer:
         # temporary storage of parent url:key to parent_id:value.
         parent_ids = {}
 
-        self.sq_cur.execute("SELECT key, URL FROM sites WHERE parent IS NULL")
-        one = self.sq_cur.fetchone()
-
-        # perform the parent linking while there are entries that have no parent.
-        while one is not None:
-            key = one[0]
-            url = one[1]
+        # perform the parent linking for the entries that have no parent.
+        for key, url in self.db.unlinked_sites():
 
             # generate the parent url from own url.
             parent_url = parent_site(url)
@@ -375,13 +323,9 @@ class ConcurrentETHSiteIndexer:
                 parent_ids[parent_url] = parent_id
 
             # TODO: logging and debug shit
-            print(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
-            self.sq_cur.execute(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
-
-            # Fetch the next entry which has no parent.
-            self.sq_cur.execute("SELECT key, URL FROM sites WHERE parent IS NULL")
-            one = self.sq_cur.fetchone()
-        self.sq_con.commit()
+            print(f"Linking {key} to parent {parent_id}")
+            self.db.set_parents([(parent_id, key)])
+        self.db.commit()
 
     def get_url_id(self, url: str):
         """
@@ -390,13 +334,7 @@ class ConcurrentETHSiteIndexer:
         :param url: url to retrieve the key from.
         :return: key or -1 if no key found.
         """
-        self.sq_cur.execute(f"SELECT (key) FROM sites WHERE URL IS '{url}'")
-        query_result = self.sq_cur.fetchall()
-
-        if len(query_result) == 0 or len(query_result[0]) == 0:
-            return -1
-
-        return query_result[0][0]
+        return self.db.site_key(url)
 
     def workers_alive(self):
         """
@@ -1,23 +1,25 @@
 import os
 import traceback
 
-import requests as rq
 import multiprocessing as mp
-import queue
-import time
-import pickle
+from queue import Queue
 from threading import Thread
-import json
 from dataclasses import dataclass
 from typing import List
-from sqlite3 import *
-import datetime
+from time import monotonic, time
+
+from eth_loader.auth import LoginCache
+from eth_loader.checkpoint import WorkState
+from eth_loader.database import ACTIVE, REACTIVATED, Database
+from eth_loader.documents import EpisodeRecord, episode_record
+from eth_loader.transport import configure_worker, get_transport, worker_settings
+from eth_loader.work_tracker import STOP
 
 # gro-21w
 # fG9LdsA
 
 
-def get_stream(website_url: str, identifier: str, headers: dict, cookies: bytes, parent_id: int) -> dict:
+def get_stream(website_url: str, identifier: str, headers: dict, cookies, parent_id: int) -> EpisodeRecord:
     """
     Function to download a single metadata file for a given video_site and video entry. The website_url needs to be of type:
 
@@ -30,58 +32,79 @@ def get_stream(website_url: str, identifier: str, headers: dict, cookies: bytes,
     The function **expects** to receive a valid lecture url. If an url is provided, that doesn't contain a video,
     it will try to download it anyway. The function shouldn't fail except if the site doesn't exist.
 
-    :param cookies:
+    :param cookies: cookie jar with the login cookies, None without login
     :param website_url: url to download eg. /category/subcategory/year/season/lecture_id.html
     :param identifier: str for thread to give information where the download was executed in case of an error.
     :param headers: dict to be passed to the request library. Download will fail if no user-agent is provided.
+    :param parent_id: key of the metadata entry of the series
+    :return: record with the parsed and compressed document, see documents.py
     """
 
     url = website_url.replace("\n", "")
-    cj = pickle.loads(cookies)
 
-    result = rq.get(url=url, headers=headers, cookies=cj)
+    result = get_transport().get(url, headers=headers, cookies=cookies, stage="streams")
     content = None
     # https://www.asdf.com/path?args
 
     if result.ok:
-        content = result.content.decode("utf-8")
+        content = result.content
     else:
         # TODO: logging and debug shit
         print(f"{identifier} error {result.status_code}")
 
-    return {"url": url,  "status": result.status_code, "content": content, "parent_id": parent_id}
+    # parsed here instead of in the writer, which only stores the record.
+    return episode_record(url=url, parent_id=parent_id, status=result.status_code, raw=content)
 
 
-def handler(worker_nr: int, command_queue: mp.Queue, result_queue: mp.Queue):
+def handler(worker_nr: int, command_queue: Queue, result_queue: Queue, logins: LoginCache = None,
+            settings: dict = None):
     """
-    Function executed in a worker thread. The function tries to download the given url in the queue. If the queue is
-    empty for 20s, it will kill itself.
+    Function executed in a worker thread (or process). The function tries to download the given url in the queue. It
+    exits when it dequeues the STOP sentinel and puts a STOP sentinel in the result queue, so the writer knows it is
+    done.
 
     :param worker_nr: Itendifier for debugging
     :param command_queue: Queue containing dictionaries containing all relevant information for downloading
     :param result_queue: Queue to put the results in. Handled in main thread.
+    :param logins: login cache of the loader, used to log in again if a login expired mid run. None for worker
+    processes, they report the 401 / 403 and a resumed run retries the episode.
+    :param settings: transport settings of the parent (worker_settings), only passed to worker processes
     :return:
     """
     # TODO: logging and debug shit
     print("Starting")
-    ctr = 0
-    while ctr < 20:
-        try:
-            arguments = command_queue.get(block=False)
-            ctr = 0
-        except queue.Empty:
-            ctr += 1
-            time.sleep(1)
-            continue
-
-        result = get_stream(arguments["url"], str(worker_nr),
-                            headers={"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) "
-                                                   "Gecko/20100101 Firefox/100.0"}, cookies=arguments["cookie-jar"],
-                            parent_id=arguments["parent_id"])
-
-        result_queue.put(result)
-    # TODO: logging and debug shit
-    print(f"{worker_nr} Terminated")
+    headers = {"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0"}
+    try:
+        # inside the try, a worker failing to configure still puts its STOP sentinel
+        if settings is not None:
+            configure_worker(settings)
+
+        while True:
+            arguments = command_queue.get()
+
+            if arguments is STOP:
+                break
+
+            try:
+                sent = time()
+                result = get_stream(arguments["url"], str(worker_nr), headers=headers,
+                                    cookies=arguments["cookie-jar"], parent_id=arguments["parent_id"])
+
+                # the login expired, log in again (once for all workers) and retry
+                if logins is not None and len(arguments["logins"]) > 0 and result.status in (401, 403):
+                    logins.invalidate(arguments["logins"], sent)
+                    result = get_stream(arguments["url"], str(worker_nr), headers=headers,
+                                        cookies=logins.cookies(arguments["logins"]), parent_id=arguments["parent_id"])
+            except Exception:
+                # TODO: logging and debug shit
+                print(traceback.format_exc())
+                result = EpisodeRecord(url=arguments["url"], parent_id=arguments["parent_id"], status=-1)
+
+            result_queue.put(result)
+    finally:
+        result_queue.put(STOP)
+        # TODO: logging and debug shit
+        print(f"{worker_nr} Terminated")
 
 
 # DEPRECATED
@@ -135,7 +158,7 @@ class BetterStreamLoader:
     Class loads all stream file urls for the given database.
     """
     def __init__(self, db: str, user_name: str = None, password: str = None,
-                 spec_login: List[SpecLogin] = None):
+                 spec_login: List[SpecLogin] = None, queue_size: int = 256, processes: bool = False):
 
         """
 
@@ -143,17 +166,21 @@ class BetterStreamLoader:
         :param user_name:
         :param password:
         :param spec_login:
+        :param queue_size: capacity of the command and the result queue, workers block while the writer is behind
+        :param processes: run the workers in processes instead of threads, see spawn
         """
 
         self.db_path = os.path.abspath(db)
         self.download_list = []
 
-        self.sq_con = Connection(self.db_path)
-        self.sq_cur = self.sq_con.cursor()
+        # written by the writer thread, see start_writer
+        self.db = Database(self.db_path, check_same_thread=False)
 
         self.get_episode_urls()
         self.check_results_table()
 
+        self.work_state = WorkState(self.db.con, "streams")
+
         if spec_login is not None:
             self.specific_urls = [entry.url for entry in spec_login]
             self.specific_auth = spec_login
@@ -172,19 +199,33 @@ class BetterStreamLoader:
             self.specific_urls[i] = self.specific_urls[i].replace(".html", "").replace(".series-metadata.json", "")
 
         self.workers = []
-
-        self.result_queue = mp.Queue()
-        self.command_queue = mp.Queue()
+        self.writer = None
+
+        # bounded, so only queue_size results are held in memory at any time. Threads share in process queues, only
+        # worker processes need the pickling and pipes of a mp.Queue.
+        self.processes = processes
+        if processes:
+            self.context = mp.get_context("spawn")
+            self.result_queue = self.context.Queue(maxsize=queue_size)
+            self.command_queue = self.context.Queue(maxsize=queue_size)
+        else:
+            self.context = None
+            self.result_queue = Queue(maxsize=queue_size)
+            self.command_queue = Queue(maxsize=queue_size)
 
         self.nod = len(self.download_list)
 
         # TODO: logger and debug shit
         print(f"TODO: {self.nod}")
-        time.sleep(10)
 
         self.general_cookie = None
         self.login(user_name, password)
 
+        # one login per protected series (or episode), shared by all of its episodes
+        self.logins = LoginCache({url: (auth.username, auth.password)
+                                  for url, auth in zip(self.specific_urls, self.specific_auth)},
+                                 login=self.spec_login, default=self.general_cookie)
+
     def get_episode_urls(self):
         """
         Retrieves the urls for all episodes from the metadata (series-metadata.json of first episode) table.
@@ -194,120 +235,52 @@ class BetterStreamLoader:
         # verify existence of source table
         self.verify_args_table()
 
-        # select first entry
-        self.sq_cur.execute("SELECT key, json, URL FROM metadata WHERE deprecated = 0")
-        row = self.sq_cur.fetchone()
-
-        while row is not None:
-            parent_id = row[0]
-            content = row[1]
-            parent_url = row[2]
-
-            # why was this again important?
-            content_default = content.replace("''", "'")
-
-            # cannot process a html site. We skip this entry.
-            if "<!DOCTYPE html>" in content_default:
-
-                # TODO: logging and debug shit
-                print(f"Found an html site: {parent_url}")
-
-                row = self.sq_cur.fetchone()
-                continue
+        # the episode ids were extracted when the metadata was stored, no need to parse the documents.
+        for parent_id, parent_url, episodes in self.db.active_series():
 
-            # try to retrieve the json information. from the content.
-            try:
-                result = json.loads(content_default)
-            except json.JSONDecodeError:
+            # html sites and documents without episodes
+            if episodes is None:
                 # TODO: logging and debug shit
-                print(traceback.format_exc())
-                print(content_default)
-                print(parent_url)
-
-                row = self.sq_cur.fetchone()
+                print(f"No episodes found {parent_url}")
                 continue
 
-            # continue with the dict
-            result: dict
-
-            # verify existence of episodes key
-            if result.get("episodes") is not None:
-                episodes = result.get("episodes")
-
-                # iterate over episodes.
-                for ep in episodes:
-                    ep_id = ep.get("id")
-
-                    # verify existence of episode id.
-                    if ep_id is None:
-                        # TODO: logging and debug shit
-                        print(f"Failed to generate id with Content:\n{content_default}")
-                        continue
+            # parent url without file extension
+            strip_url = parent_url.replace(".html", "").replace(".series-metadata.json", "")
 
-                    # parent url without file extension
-                    strip_url = parent_url.replace(".html", "").replace(".series-metadata.json", "")
+            for ep_id in episodes:
+                # episode url with file extension
+                ep_url = f"{strip_url}/{ep_id}.series-metadata.json"
 
-                    # episode url with file extension
-                    ep_url = f"{strip_url}/{ep_id}.series-metadata.json"
-
-                    self.download_list.append(EpisodeEntry(parent_id=parent_id, series_url=parent_url,
-                                                           episode_url=ep_url))
-
-            else:
-                # TODO: logging and debug shit
-                print(f"No episodes found {parent_url}")
-
-            row = self.sq_cur.fetchone()
+                self.download_list.append(EpisodeEntry(parent_id=parent_id, series_url=parent_url,
+                                                       episode_url=ep_url))
 
     def verify_args_table(self):
         """
-        Verifies a Table exists inside the given sqlite database.
+        Verifies a Table exists inside the given sqlite database and migrates it, so the episode ids of metadata
+        written by an older version are available.
         :return:
         """
 
         # TODO: Verify columns and type match
 
-        self.sq_cur.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name='metadata'")
-
-        if self.sq_cur.fetchone() is None:
+        if not self.db.table_exists("metadata"):
             raise ValueError("didn't find the 'sites' table inside the given database.")
 
+        self.db.create_metadata()
+
     def check_results_table(self):
         """
         Checks if the tables for the results exist already in the database and otherwise creates the tables.
         :return:
         """
-        # check if the episodes table exists already.
-        self.sq_cur.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name='episodes'")
-
-        # if it doesn't exist, create a results table.
-        if self.sq_cur.fetchone() is None:
-            self.sq_cur.execute("CREATE TABLE episodes "
-                                "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
-                                "parent INTEGER, "
-                                "URL TEXT , "
-                                "json TEXT,"
-                                "deprecated INTEGER DEFAULT 0 CHECK (episodes.deprecated >= 0 AND episodes.deprecated <= 1),"
-                                "found TEXT,"
-                                "streams TEXT)")
-
-        # check that the streams table exists
-        self.sq_cur.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name='streams'")
-
-        # create the table if it doesn't exist.
-        if self.sq_cur.fetchone() is None:
-            self.sq_cur.execute("CREATE TABLE streams "
-                                "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
-                                "URL TEXT , "
-                                "resolution TEXT,"
-                                "deprecated INTEGER DEFAULT 0 CHECK (deprecated >= 0 AND deprecated <= 1),"
-                                "found TEXT)")
-
-            self.sq_cur.execute("INSERT INTO streams (key, URL, resolution, found) VALUES (-1, 'dummy', 'dummy', 'dummy')")
+        self.db.create_episodes()
 
     def spawn(self, threads: int = 100):
         """
-        Spawns worker threads.
+        Spawns worker threads, or processes if the loader was created with processes=True. Worker processes are
+        started with the spawn method, so the script needs an if __name__ == "__main__" guard. Each process configures
+        its own transport like the one of the parent, the rate limits are split evenly between the processes (see
+        worker_settings). The byte counters of the processes aren't reported.
 
         :param threads: number of threads to spawn 1-10000
         :return:
@@ -315,36 +288,60 @@ class BetterStreamLoader:
         if not 1 < threads < 10000:
             raise ValueError("Thread number outside supported range [1:10'000]")
 
+        settings = worker_settings(threads) if self.processes else None
+
         self.workers = []
         for i in range(threads):
-            t = Thread(target=handler, args=(i, self.command_queue, self.result_queue))
+            if self.processes:
+                t = self.context.Process(target=handler, args=(i, self.command_queue, self.result_queue, None,
+                                                               settings))
+            else:
+                t = Thread(target=handler, args=(i, self.command_queue, self.result_queue, self.logins))
             t.start()
             self.workers.append(t)
 
         print("Workers Spawned")
 
-    def initiator(self, workers: int = 100):
+    def initiator(self, workers: int = 100, resume: bool = False):
         """
         Runs the entire job basically. Starts all threads, retrieves all values, stores the database and does the
         clenaup.
 
         :param workers: number of workers in parallel.
+        :param resume: only download the episodes the previous run didn't finish, full run if there is none
         :return:
         """
-        self.spawn(workers)
-        self.enqueue_job()
-        self.dequeue_job()
-
-        while self.workers_alive():
-            time.sleep(30)
-            print("Initiator Thread Sleeping Workers")
-
-        self.cleanup()
-        self.sq_con.commit()
+        try:
+            self.spawn(workers)
+            self.enqueue_job(resume)
+        finally:
+            # one sentinel per worker, behind all the episodes. Also put if the enqueueing failed, so the workers and
+            # the writer exit before the error is raised.
+            for _ in range(len(self.workers)):
+                self.command_queue.put(STOP)
+
+            # the writer drains the STOP sentinels of the workers, even if the enqueueing failed before it started
+            if self.writer is None:
+                self.start_writer()
+
+            self.writer.join()
+            self.cleanup()
+
+        self.db.commit()
         self.deprecate_streams()
-        self.sq_con.commit()
+        self.db.commit()
+        print(get_transport().bytes.report("streams"))
         print("DONE")
 
+    def start_writer(self):
+        """
+        Starts the thread storing the results (dequeue_job). It's the only thread using the database until it is
+        joined, so the results are drained while the episodes are still being enqueued.
+        :return:
+        """
+        self.writer = Thread(target=self.dequeue_job)
+        self.writer.start()
+
     def cleanup(self):
         """
         Waits for all worker processes to terminate and then joins them.
@@ -352,7 +349,7 @@ class BetterStreamLoader:
         """
         for worker in self.workers:
             worker: Thread
-            worker.join(10)
+            worker.join()
 
     def workers_alive(self):
         """
@@ -379,10 +376,11 @@ class BetterStreamLoader:
             print("No Credentials")
             return
 
-        login = rq.post(url="https://video.ethz.ch/j_security_check",
-                        headers={"user-agent": "lol herre"}, data={"_charset_": "utf-8", "j_username": usr,
-                                                                   "j_password": pw,
-                                                                   "j_validate": True})
+        login = get_transport().post("https://video.ethz.ch/j_security_check",
+                                     headers={"user-agent": "lol herre"},
+                                     data={"_charset_": "utf-8", "j_username": usr, "j_password": pw,
+                                           "j_validate": True},
+                                     stage="streams")
 
         if login.ok:
             self.general_cookie = login.cookies
@@ -404,16 +402,18 @@ class BetterStreamLoader:
         :param pw: password for the specific login
         :param usr: username for the specific login
         :param strip_url: url where to perform the specific login
-        :return:
+        :return: cookie jar with the specific and the general login, None if the login failed
         """
         strip_url = strip_url.replace("www.", "")
-        login = rq.post(url=f"{strip_url}.series-login.json",
-                        headers={"user-agent": "lol herre"},
-                        data={"_charset_": "utf-8", "username": usr, "password": pw},
-                        cookies=self.general_cookie)
+        login = get_transport().post(f"{strip_url}.series-login.json",
+                                     headers={"user-agent": "lol herre"},
+                                     data={"_charset_": "utf-8", "username": usr, "password": pw},
+                                     cookies=self.general_cookie,
+                                     stage="streams")
         if login.ok:
             cj = login.cookies
-            cj.update(self.general_cookie)
+            if self.general_cookie is not None:
+                cj.update(self.general_cookie)
 
             if other_cookies is not None:
                 cj.update(other_cookies)
@@ -423,255 +423,139 @@ class BetterStreamLoader:
             # TODO: logging and debug shit
             print(login.status_code)
             print(vars(login))
-            return self.general_cookie
+            return None
 
-    def enqueue_job(self):
+    def enqueue_job(self, resume: bool = False):
         """
         Enqueues all episodes in the download_list.
 
         It verifies that url of the series or the episode itself is not in
         the spec_login list.
 
-        If it is, it performs the login for the specific episode or series and adds the cookie
-        authentication to the command for the downloaders.
+        If it is, the cookie authentication of the specific episode or series is added to the command for the
+        downloaders. All distinct logins are performed concurrently before the first episode is enqueued and reused
+        for all episodes (see LoginCache). Starts the writer once the logins are done and blocks while the command
+        queue is full.
+
+        :param resume: skip the episodes the previous run finished
         :return:
         """
-        for dl in self.download_list:
-            dl: EpisodeEntry
-            cookie = self.general_cookie
+        download_list = self.download_list
 
-            # url without file extension
-            strip_url = dl.series_url.replace(".html", "").replace(".series-metadata.json", "")
-            episode_striped_url = dl.episode_url.replace(".html", "").replace(".series-metadata.json", "")
+        if resume and self.work_state.has_run():
+            done = self.work_state.done()
+            download_list = [dl for dl in self.download_list if dl.episode_url not in done]
+            print(f"Resuming with {len(download_list)} of {len(self.download_list)} episodes")
+        else:
+            self.work_state.reset()
+            self.work_state.add_pending([(dl.episode_url, None) for dl in download_list])
 
-            # if the stripped url is a specified url, get login of that url as well
-            if strip_url in self.specific_urls:
-                index = self.specific_urls.index(strip_url)
+        self.work_state.mark_in_flight([dl.episode_url for dl in download_list])
+        self.db.commit()
 
-                cookie = self.spec_login(strip_url, self.specific_auth[index].username,
-                                         self.specific_auth[index].password)
+        # all distinct logins at once, instead of one serial login per episode
+        logins = [self.login_keys(dl) for dl in download_list]
+        self.logins.login_all(key for keys in logins for key in keys)
 
-            # get specific login for specific episode if necessary
-            if episode_striped_url in self.specific_urls:
-                index = self.specific_urls.index(strip_url)
+        self.start_writer()
 
-                cookie = self.spec_login(strip_url, self.specific_auth[index]["username"],
-                                                 self.specific_auth[index]["password"], other_cookies=cookie)
-            cookie_jar = pickle.dumps(cookie)
+        for dl, keys in zip(download_list, logins):
+            dl: EpisodeEntry
 
+            # the jar is shared by the worker threads, it's only pickled if the workers are processes
             print(f"Enqueueing: {dl.episode_url}")
-            self.command_queue.put({"url": dl.episode_url, "cookie-jar": cookie_jar, "parent_id": dl.parent_id})
+            self.command_queue.put({"url": dl.episode_url, "cookie-jar": self.logins.cookies(keys), "logins": keys,
+                                    "parent_id": dl.parent_id})
+
+    def login_keys(self, dl: EpisodeEntry) -> tuple:
+        """
+        The stripped urls of the specific logins needed by an episode, its series and / or the episode itself.
 
-    def dequeue_job(self):
+        :param dl: episode to download
+        :return: keys of the LoginCache
+        """
+        # url without file extension
+        strip_url = dl.series_url.replace(".html", "").replace(".series-metadata.json", "")
+        episode_striped_url = dl.episode_url.replace(".html", "").replace(".series-metadata.json", "")
+
+        return self.logins.keys(strip_url, episode_striped_url)
+
+    def dequeue_job(self, commit_interval: float = 5.0):
         """
         Dequeues the results from the results queue. It then stores the results in the results table.
+        Returns once every worker put its STOP sentinel.
+
+        :param commit_interval: seconds between commits, the results and work state are checkpointed with each commit
         :return:
         """
-        # counter to prevent infinite loop
-        ctr = 0
-        while ctr < 20:
+        last_commit = monotonic()
+        running = len(self.workers)
+        while running > 0:
             # dequeue
-            if not self.result_queue.empty():
-                try:
-                    res = self.result_queue.get()
-
-                    # verify the correct download of the episode metadata
-                    if res["status"] == 200:
-
-                        # TODO NEEDS TO BE STORED IN b64
-                        content = res["content"].replace("'", "''")
-
-                        # why is res['content'] read twice?
-                        self.insert_update_episodes(parent_id=res["parent_id"], url=res["url"],
-                                                    json_str=content, raw_content=res["content"])
-                    else:
-                        # TODO: logging and debug shit
-                        print(f"url {res['url']} with status code {res['status']}")
-                    ctr = 0
-                except Exception as e:
+            res = self.result_queue.get()
+
+            if res is STOP:
+                running -= 1
+                continue
+
+            res: EpisodeRecord
+            try:
+                # verify the correct download of the episode metadata
+                if res.status == 200:
+                    if res.payload is not None:
+                        self.insert_update_episodes(res)
+
+                    # failed downloads stay unfinished, a resumed run retries them.
+                    self.work_state.mark_done([res.url])
+                else:
                     # TODO: logging and debug shit
-                    print("\n\n\n FUCKING EXCEPTION \n\n\n")
-                    print(traceback.format_exc())
-            else:
-                time.sleep(1)
-                ctr += 1
+                    print(f"url {res.url} with status code {res.status}")
+            except Exception:
+                # TODO: logging and debug shit
+                print("\n\n\n FUCKING EXCEPTION \n\n\n")
+                print(traceback.format_exc())
+
+            if monotonic() - last_commit >= commit_interval:
+                self.db.commit()
+                last_commit = monotonic()
 
-    def insert_update_episodes(self, parent_id: int, url: str, json_str: str, raw_content: str):
+    def insert_update_episodes(self, record: EpisodeRecord):
         """
-        Given the parent_id (key), the url of the episode, the json_string associated with the episode and the content
-        of the episode site, it updates the stream and episodes table. Updating or inserting depending on presence and
-        deprecated state.
+        Given the record of a downloaded episode, it updates the stream and episodes table. Updating or inserting
+        depending on presence and deprecated state. Episodes are compared by the content_hash of their json instead of
+        the json itself. The worker already parsed the document, the streams are taken from the record.
 
-        :param parent_id: key of the parent entry. (Series in XXX table) # TODO look up table
-        :param url: url of the episode that was downloaded
-        :param json_str: json string of the series site???
-        :param raw_content: json content that was the response for the series.
+        :param record: result of the worker with status 200 and a payload
         :return:
         """
-        try:
-            # parse json content
-            episode = json.loads(raw_content)
-        except json.JSONDecodeError:
-            # TODO: logging and debug shit
-            print(f"Failed to load raw content of {url},\n{raw_content}")
-            return -1
-        sel_ep = episode.get("selectedEpisode")
-
-        episode_stream_ids = []
-
-        # verify selectedEpisode key exists
-        if sel_ep is not None:
-            media = sel_ep.get("media")
-
-            # verify media key exists
-            if media is not None:
-                presentations = media.get("presentations")
-
-                # verify presentations key exists
-                if presentations is not None:
-                    for i in range(len(presentations)):
-                        p = presentations[i]
-                        width = p.get("width")
-
-                        # try to retrieve width, ignore if it doesn't exist
-                        # TODO: proceed but put warning
-                        if width is None:
-                            # TODO: logging and debug shit
-                            print(f"Failed to retrieve WIDTH {width}")
-                            continue
-
-                        height = p.get("height")
-
-                        # try to retrieve height, ignore if it doesn't exist
-                        # TODO: proceed but put warning
-                        if height is None:
-                            # TODO: logging and debug shit
-                            print(f"Failed to retrieve HEIGHT {height}")
-                            continue
-
-                        resolution_string = f"{width} x {height}"
-                        url = p.get("url")
-
-                        # verify url key exists
-                        if p.get("url") is None:
-                            # TODO: logging and debug shit
-                            print(f"Failed to retrieve URL {p}")
-                            continue
-
-                        episode_stream_ids.append(self.insert_update_streams(url=url, resolution=resolution_string))
-
-        # list of ids in streams table associated with current episode.
-        stream_string = json.dumps(episode_stream_ids)
-
-        # exists:
-        self.sq_cur.execute(
-            f"SELECT key FROM episodes WHERE "
-            f"parent = {parent_id} AND "
-            f"URL = '{url}' AND "
-            f"json = '{json_str}' AND "
-            f"deprecated = 0 AND "
-            f"streams = '{stream_string}'")
-
-        # it exists, abort
-        if self.sq_cur.fetchone() is not None:
-            # TODO: logging and debug shit
-            print("Found active in db")
-            return
-
-        # exists but is deprecated
-        self.sq_cur.execute(
-            f"SELECT key FROM episodes WHERE "
-            f"parent = {parent_id} AND "
-            f"URL = '{url}' AND "
-            f"json = '{json_str}' AND "
-            f"deprecated = 1 AND "
-            f"streams = '{stream_string}'")
-
-        result = self.sq_cur.fetchone()
-        if result is not None:
-            # TODO: logging and debug shit
-            print(
-                "Found inactive in db, reacivate and set everything else matching parent, url and series to deprecated")
-
-            # update all entries, to deprecated, unset deprecated where it is here (???)
-            # TODO: why is first action performed
-            self.sq_cur.execute(
-                f"UPDATE episodes SET deprecated = 1 WHERE parent = {parent_id} AND URL = '{url}'")
-            self.sq_cur.execute(f"UPDATE episodes SET deprecated = 0 WHERE key = {result}")
-            return
+        episode_stream_ids = [self.insert_update_streams(url=stream_url, resolution=resolution)
+                              for stream_url, resolution in record.streams]
 
-        # doesn't exist -> insert
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        state = self.db.upsert_episode(record.parent_id, record.url, record.payload, record.content_hash,
+                                       episode_stream_ids)
 
         # TODO: logging and debug shit
-        print("Inserting")
-        self.sq_cur.execute(
-            f"INSERT INTO episodes (parent, URL, json, found, streams) VALUES ({parent_id}, '{url}', '{json_str}', '{now}', '{stream_string}')")
+        if state == ACTIVE:
+            print("Found active in db")
+        elif state == REACTIVATED:
+            print(
+                "Found inactive in db, reacivate and set everything else matching parent, url and series to deprecated")
+        else:
+            print("Inserting")
 
-    def insert_update_streams(self, url: str, resolution: str):
+    def insert_update_streams(self, url: str, resolution: str) -> int:
         """
         Insert the stream into the database. If it exists update the database accordingly.
         :param url: url of the stream
         :param resolution: resolution of the stream
-        :return:
+        :return: key of the stream
         """
-        # exists:
-        self.sq_cur.execute(
-            f"SELECT key FROM streams WHERE URL = '{url}' AND resolution = '{resolution}' AND deprecated = 0")
-
-        # it exists, abort
-        key = self.sq_cur.fetchone()
-        if key is not None:
-            # TODO: logging and debug shit
-            print("Found active in db")
-            return key
-
-        # exists but is deprecated
-        self.sq_cur.execute(
-             f"SELECT key FROM streams WHERE URL = '{url}' AND resolution = '{resolution}' AND deprecated = 1")
-
-        result = self.sq_cur.fetchone()
-        if result is not None:
-            # TODO: logging and debug shit
-            print(
-                "Found inactive in db, reacivate and set everything else matching parent, url and series to deprecated")
-
-            # update all entries, to deprecated, unset deprecated where it is here (???)
-            # update to not deprecated where the key matches.
-            self.sq_cur.execute(f"UPDATE streams SET deprecated = 0 WHERE key = {result}")
-            return result
-
-        # doesn't exist -> insert
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # TODO: logging and debug shit
-        print("Inserting")
-        self.sq_cur.execute(
-            f"INSERT INTO streams (URL, resolution, found) VALUES ('{url}', '{resolution}', '{now}')")
-
-        self.sq_cur.execute(
-            f"SELECT key FROM streams WHERE URL IS '{url}' AND  resolution IS '{resolution}' AND found IS '{now}'")
-
-        # return the key
-        return self.sq_cur.fetchone()
+        return self.db.upsert_stream(url, resolution)
 
     def deprecate_streams(self):
         """
-        Iterate over all episodes that aren't deprecated and make them deprecated if there is no episode entry
-        storing them.
+        Deprecates the streams which aren't referenced by any episode anymore.
         :return:
         """
-        self.sq_cur.execute("SELECT key FROM streams WHERE deprecated = 0")
-
-        row = self.sq_cur.fetchone()
-        while row is not None:
-            key = row[0]
-
-            self.sq_cur.execute(f"SELECT key FROM episodes WHERE streams LIKE '%{key}%'")
-
-            if self.sq_cur.fetchone() is None:
-                print(f"Deprecating entry: {key}")
-                self.sq_cur.execute(f"UPDATE streams SET deprecated = 1 WHERE key = {key}")
-
-            self.sq_cur.execute("SELECT key FROM streams WHERE deprecated = 0")
-            row = self.sq_cur.fetchone()
+        # TODO: logging and debug shit
+        print(f"Deprecated {self.db.deprecate_streams()} streams")
@@ -0,0 +1,524 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from time import monotonic, sleep
+
+import requests as rq
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+
+from eth_loader.accounting import ByteCounters
+from eth_loader.concurrency import AIMDController
+from eth_loader.deadlines import DeadlineExceeded, LatencyTracker, StallDetector
+from eth_loader.rate_limit import HostRateLimiter
+from eth_loader.retry import CircuitBreakers, RetryPolicy
+
+"""
+# Shared HTTP transport
+
+All stages (indexer, metadata loader, stream loader) fetch through the same Transport. Every worker thread gets its
+own requests.Session, which keeps the connections to video.ethz.ch alive between requests, so a worker only pays the
+TCP and TLS handshake once instead of once per request.
+
+Use get_transport() to retrieve the shared instance and configure() to replace it with a differently sized one before
+the workers are spawned. Worker processes have their own transport, they configure it with the worker_settings of the
+parent (configure_worker).
+
+If the transport has an AIMDController, every request takes a slot of the controller and reports its latency and
+status to it, so the number of concurrent requests of all stages adapts to the health of the server.
+
+If the transport has a HostRateLimiter, every request waits for a token of its host before it is sent and the received
+bytes are charged to the byte budget of the host. Video downloads use download(), which charges every chunk.
+
+Failed requests are retried according to the RetryPolicy of the transport and every host has a circuit breaker which
+pauses all requests to it during an outage, see retry.py.
+
+Optionally every attempt has a deadline for the whole response and GET requests are hedged at the p95 latency of the
+transport, see deadlines.py. Hedged requests are sent from a pool of the transport, not from the calling thread, so
+cookies need to be passed per request.
+
+Every request advertises compressed transfers (brotli only if a brotli module is installed, urllib3 can't decode it
+otherwise) and counts its wire and decoded bytes for the stage passed as 'stage', see accounting.py.
+"""
+
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+DEFAULT_HEADERS = {"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0"}
+
+
+class Transport:
+    """
+    Pool of keep-alive connections. Sessions are not thread safe, so each thread gets its own session (and with it its
+    own connection pool).
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 10.0, read_timeout: float = 60.0,
+                 headers: dict = None, controller: AIMDController = None, rate_limiter: HostRateLimiter = None,
+                 retry_policy: RetryPolicy = None, circuit_breakers: CircuitBreakers = None, deadline: float = None,
+                 hedge: bool = False, hedge_workers: int = 200):
+        """
+        :param pool_size: number of connections kept alive per host and worker
+        :param connect_timeout: seconds to wait for the connection to be established
+        :param read_timeout: seconds to wait between bytes received from the server
+        :param headers: default headers sent with every request, overwritten by headers passed per request.
+        :param controller: adaptive limit of concurrent requests, None for no limit besides the number of workers
+        :param rate_limiter: per host limit of requests and bytes per second, None for no limit
+        :param retry_policy: retries of failed requests, defaults to RetryPolicy(), RetryPolicy(max_attempts=1) to
+            disable retries
+        :param circuit_breakers: circuit breakers of the hosts, defaults to CircuitBreakers()
+        :param deadline: seconds an attempt may take including the body, None to only rely on the timeouts
+        :param hedge: send a duplicate of GET requests not answered within the p95 latency, first answer wins
+        :param hedge_workers: threads sending hedged requests, should be at least twice the number of workers
+        """
+        if pool_size < 1:
+            raise ValueError("pool_size needs to be at least 1")
+
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers = {"accept-encoding": ACCEPT_ENCODING, **(DEFAULT_HEADERS if headers is None else headers)}
+        self.controller = controller
+        self.rate_limiter = rate_limiter
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.circuit_breakers = CircuitBreakers() if circuit_breakers is None else circuit_breakers
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_workers = hedge_workers
+        self.latencies = LatencyTracker()
+        self.bytes = ByteCounters()
+
+        self.__local = threading.local()
+        self.__hedge_pool: ThreadPoolExecutor = None
+        self.__hedge_lock = threading.Lock()
+
+    def session(self) -> rq.Session:
+        """
+        Returns the session of the calling thread, creates it on first use.
+        :return:
+        """
+        session = getattr(self.__local, "session", None)
+
+        if session is None:
+            session = rq.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(self.headers)
+            self.__local.session = session
+
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> rq.Response:
+        """
+        Performs a request with the session of the calling thread. Arguments are the same as for requests.request,
+        the default timeout is applied if none is given. Retryable failures are retried, the response of the last
+        attempt is returned and the exception of the last attempt is raised.
+
+        :param method: http method like GET or POST
+        :param url: url to request
+        :param stage: keyword only, name of the stage the bytes of the response are counted for, defaults to 'other'
+        :return:
+        """
+        stage = kwargs.pop("stage", "other")
+        kwargs.setdefault("timeout", self.timeout)
+        breaker = self.circuit_breakers.get(url)
+        hedged = self.hedge and method.upper() == "GET" and not kwargs.get("stream", False)
+        attempt = 0
+
+        while True:
+            breaker.wait()
+
+            try:
+                if hedged:
+                    resp = self.__hedged_attempt(method, url, **kwargs)
+                else:
+                    resp = self.__attempt(method, url, **kwargs)
+            except Exception as e:
+                if not self.retry_policy.is_retryable_error(e):
+                    # the host wasn't the problem
+                    breaker.record_success()
+                    raise
+
+                breaker.record_failure()
+                if attempt + 1 >= self.retry_policy.max_attempts:
+                    raise
+
+                delay = self.retry_policy.delay(attempt)
+
+                # TODO: logging and debug shit
+                print(f"Retrying {url} in {delay:.1f}s after {e!r}")
+            else:
+                if not self.retry_policy.is_retryable_status(resp.status_code):
+                    breaker.record_success()
+                    break
+
+                breaker.record_failure()
+                if attempt + 1 >= self.retry_policy.max_attempts:
+                    break
+
+                delay = self.retry_policy.delay(attempt, resp.headers.get("Retry-After"))
+                resp.close()
+
+                # TODO: logging and debug shit
+                print(f"Retrying {url} in {delay:.1f}s after status {resp.status_code}")
+
+            sleep(delay)
+            attempt += 1
+
+        # streamed bodies are counted and charged by the consumer, see download()
+        if not kwargs.get("stream", False):
+            wire = self.wire_bytes(resp)
+            self.bytes.add(stage, url, wire, len(resp.content))
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait_bytes(url, wire)
+
+        return resp
+
+    @staticmethod
+    def wire_bytes(resp: rq.Response) -> int:
+        """
+        Bytes of the body received from the connection, before decompression. Only complete after the body was read.
+
+        :param resp: response
+        :return:
+        """
+        try:
+            return resp.raw.tell()
+        except (AttributeError, OSError):
+            return len(resp.content)
+
+    def __attempt(self, method: str, url: str, admitted: threading.Event = None, **kwargs) -> rq.Response:
+        """
+        Single attempt of a request, waits for the rate limiter and the concurrency controller.
+
+        :param admitted: set once the attempt got its token and slot, right before the request is sent
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait_request(url)
+
+        if self.controller is None:
+            if admitted is not None:
+                admitted.set()
+            return self.__send(method, url, **kwargs)
+
+        with self.controller.slot():
+            if admitted is not None:
+                admitted.set()
+            start = monotonic()
+            try:
+                resp = self.__send(method, url, **kwargs)
+            except (rq.ConnectionError, rq.Timeout):
+                self.controller.record(monotonic() - start, error=True)
+                raise
+
+            self.controller.record(monotonic() - start, resp.status_code)
+            return resp
+
+    def __send(self, method: str, url: str, **kwargs) -> rq.Response:
+        """
+        Sends the request with the session of the calling thread, reads the body within the deadline and records the
+        latency.
+        """
+        stream = kwargs.get("stream", False)
+        start = monotonic()
+
+        if self.deadline is None or stream:
+            resp = self.session().request(method, url, **kwargs)
+        else:
+            kwargs["stream"] = True
+            resp = self.session().request(method, url, **kwargs)
+            timeout = kwargs.get("timeout")
+            self.__read_body(resp, start + self.deadline, timeout[1] if isinstance(timeout, tuple) else timeout)
+
+        # the latency of streamed requests only covers the headers, it would skew the percentiles.
+        if not stream:
+            self.latencies.record(monotonic() - start)
+
+        return resp
+
+    @staticmethod
+    def __socket(resp: rq.Response):
+        """
+        Socket the body of a streamed response is read from, None if it can't be found (other urllib3 versions).
+        """
+        try:
+            return resp.raw._fp.fp.raw._sock
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def __read_body(resp: rq.Response, deadline: float, read_timeout: float = None):
+        """
+        Reads the body of a streamed response, raises DeadlineExceeded if it isn't complete at the deadline. Every read
+        from the socket is bounded by the time left until the deadline and returns whatever arrived (read1), so a
+        server trickling the body can't keep the attempt alive past the deadline.
+
+        :param resp: streamed response
+        :param deadline: monotonic time at which the body needs to be complete
+        :param read_timeout: read timeout of the request, reads never wait longer than it
+        :return:
+        """
+        chunks = []
+        sock = Transport.__socket(resp)
+
+        # read1 returns after a single read from the socket, read (urllib3 < 2) fills the whole chunk
+        read = getattr(resp.raw, "read1", None) or resp.raw.read
+
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"Deadline exceeded while reading {resp.url}")
+
+                if sock is not None:
+                    sock.settimeout(remaining if read_timeout is None else min(remaining, read_timeout))
+
+                try:
+                    chunk = read(8 * 1024, decode_content=True)
+                except ReadTimeoutError as e:
+                    if monotonic() >= deadline:
+                        raise DeadlineExceeded(f"Deadline exceeded while reading {resp.url}") from e
+                    raise rq.ConnectionError(e, request=resp.request)
+                except ProtocolError as e:
+                    raise rq.ChunkedEncodingError(e)
+                except DecodeError as e:
+                    raise rq.ContentDecodingError(e)
+
+                if not chunk:
+                    break
+
+                chunks.append(chunk)
+        except Exception:
+            resp.close()
+            raise
+
+        # same as what resp.content does for a non streamed response
+        resp._content = b"".join(chunks)
+        resp._content_consumed = True
+
+    def __hedged_attempt(self, method: str, url: str, **kwargs) -> rq.Response:
+        """
+        Attempt which sends a duplicate if there is no answer within the p95 latency. The first successful answer is
+        returned, the other one is discarded when it arrives.
+
+        The p95 latency is measured from sending the request, so the hedge clock only starts once the primary got its
+        token of the rate limiter and its slot of the controller, waiting for them doesn't trigger a hedge. The hedge
+        is a regular attempt, it waits for a token and a slot of its own.
+        """
+        delay = self.latencies.percentile(95)
+
+        # not enough latencies observed yet
+        if delay is None:
+            return self.__attempt(method, url, **kwargs)
+
+        with self.__hedge_lock:
+            if self.__hedge_pool is None:
+                self.__hedge_pool = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix="hedge")
+            pool = self.__hedge_pool
+
+        admitted = threading.Event()
+        primary = pool.submit(self.__attempt, method, url, admitted=admitted, **kwargs)
+
+        # also set if the primary fails before it is admitted
+        primary.add_done_callback(lambda _: admitted.set())
+        admitted.wait()
+
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        # TODO: logging and debug shit
+        print(f"Hedging {url} after {delay:.2f}s")
+        pending = {primary, pool.submit(self.__attempt, method, url, **kwargs)}
+
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.add_done_callback(self.__discard)
+                    return future.result()
+
+            # both failed, raise the error of the last one
+            if not pending:
+                return done.pop().result()
+
+    @staticmethod
+    def __discard(future: Future):
+        """
+        Closes the response of the request which lost the race.
+        """
+        if future.exception() is None:
+            future.result().close()
+
+    def get(self, url: str, **kwargs) -> rq.Response:
+        """
+        GET request over the pooled session of the calling thread.
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> rq.Response:
+        """
+        POST request over the pooled session of the calling thread.
+        """
+        return self.request("POST", url, **kwargs)
+
+    def download(self, url: str, path: str, chunk_size: int = 1024 * 1024, min_rate: float = None,
+                 stall_window: float = 30.0, stage: str = "download", **kwargs) -> rq.Response:
+        """
+        Streams the body of a GET request into a file. Every chunk is charged to the byte budget of the rate limiter,
+        so large downloads are spread out instead of saturating the host. The file is only written for successful
+        responses. The body is streamed into path + '.part' which only replaces path once it is complete, so an
+        interrupted download never leaves a truncated file at path.
+
+        :param url: url to download
+        :param path: file to write the body to
+        :param chunk_size: bytes read from the connection at once
+        :param min_rate: bytes per second below which the download counts as stalled and DeadlineExceeded is raised,
+            None to only rely on the read timeout
+        :param stall_window: seconds over which the throughput is measured for the stall detection
+        :param stage: name of the stage the bytes are counted for
+        :return: the response, its body is consumed
+        """
+        kwargs["stream"] = True
+        resp = self.get(url, **kwargs)
+        decoded = 0
+
+        try:
+            if not resp.ok:
+                return resp
+
+            detector = None if min_rate is None else StallDetector(min_rate, stall_window)
+            part = path + ".part"
+
+            try:
+                with open(part, "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.wait_bytes(url, len(chunk))
+                        if detector is not None:
+                            detector.progress(len(chunk))
+                        f.write(chunk)
+                        decoded += len(chunk)
+
+                os.replace(part, path)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+        finally:
+            self.bytes.add(stage, url, self.wire_bytes(resp) if decoded > 0 else 0, decoded)
+            resp.close()
+
+        return resp
+
+    def close(self):
+        """
+        Closes the session of the calling thread. Sessions of other threads are closed when the thread is collected.
+        :return:
+        """
+        session = getattr(self.__local, "session", None)
+
+        if session is not None:
+            session.close()
+            self.__local.session = None
+
+
+_transport = Transport()
+
+
+def get_transport() -> Transport:
+    """
+    Returns the transport shared by all stages.
+    :return:
+    """
+    return _transport
+
+
+def configure(pool_size: int = 10, connect_timeout: float = 10.0, read_timeout: float = 60.0,
+              headers: dict = None, controller: AIMDController = None,
+              rate_limiter: HostRateLimiter = None, retry_policy: RetryPolicy = None,
+              circuit_breakers: CircuitBreakers = None, deadline: float = None, hedge: bool = False,
+              hedge_workers: int = 200) -> Transport:
+    """
+    Replaces the shared transport. Should be called before the workers are spawned, requests already in flight finish
+    on the old transport.
+
+    :param pool_size: number of connections kept alive per host and worker
+    :param connect_timeout: seconds to wait for the connection to be established
+    :param read_timeout: seconds to wait between bytes received from the server
+    :param headers: default headers sent with every request
+    :param controller: adaptive limit of concurrent requests shared by all stages, spawn the workers at its max_workers
+    :param rate_limiter: per host limit of requests and bytes per second shared by all stages
+    :param retry_policy: retries of failed requests, defaults to RetryPolicy()
+    :param circuit_breakers: circuit breakers of the hosts, defaults to CircuitBreakers()
+    :param deadline: seconds an attempt may take including the body, None to only rely on the timeouts
+    :param hedge: send a duplicate of GET requests not answered within the p95 latency
+    :param hedge_workers: threads sending hedged requests, should be at least twice the number of workers
+    :return: the new transport
+    """
+    global _transport
+    _transport = Transport(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout,
+                           headers=headers, controller=controller, rate_limiter=rate_limiter,
+                           retry_policy=retry_policy, circuit_breakers=circuit_breakers, deadline=deadline,
+                           hedge=hedge, hedge_workers=hedge_workers)
+    return _transport
+
+
+def worker_settings(processes: int) -> dict:
+    """
+    Settings of the shared transport for the transports of worker processes (see configure_worker). Processes can't
+    share the token buckets, so every process gets an even share of the rate limits. The AIMDController isn't passed,
+    every process sends one request at a time, so the number of processes bounds the concurrency.
+
+    :param processes: number of worker processes sharing the limits
+    :return: picklable settings
+    """
+    transport = get_transport()
+    connect_timeout, read_timeout = transport.timeout
+    settings = {"pool_size": transport.pool_size, "connect_timeout": connect_timeout, "read_timeout": read_timeout,
+                "headers": transport.headers, "retry_policy": transport.retry_policy,
+                "failure_threshold": transport.circuit_breakers.failure_threshold,
+                "reset_timeout": transport.circuit_breakers.reset_timeout, "deadline": transport.deadline,
+                "hedge": transport.hedge, "hedge_workers": transport.hedge_workers, "rate_limits": None}
+
+    limiter = transport.rate_limiter
+    if limiter is not None:
+        share = max(1, processes)
+        settings["rate_limits"] = {
+            "requests_per_second": limiter.requests_per_second / share, "burst": limiter.burst / share,
+            "bytes_per_second": None if limiter.bytes_per_second is None else limiter.bytes_per_second / share,
+            "byte_burst": None if limiter.byte_burst is None else limiter.byte_burst / share}
+
+    if transport.controller is not None:
+        # TODO: logging and debug shit
+        print(f"The AIMDController doesn't apply to worker processes, the {processes} processes are the limit of "
+              f"concurrent requests")
+
+    return settings
+
+
+def configure_worker(settings: dict) -> Transport:
+    """
+    Replaces the shared transport of a worker process with one configured like the transport of the parent.
+
+    :param settings: as returned by worker_settings in the parent
+    :return: the new transport
+    """
+    rate_limits = settings["rate_limits"]
+
+    return configure(pool_size=settings["pool_size"], connect_timeout=settings["connect_timeout"],
+                     read_timeout=settings["read_timeout"], headers=settings["headers"],
+                     rate_limiter=None if rate_limits is None else HostRateLimiter(**rate_limits),
+                     retry_policy=settings["retry_policy"],
+                     circuit_breakers=CircuitBreakers(settings["failure_threshold"], settings["reset_timeout"]),
+                     deadline=settings["deadline"], hedge=settings["hedge"], hedge_workers=settings["hedge_workers"])
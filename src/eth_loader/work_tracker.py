@@ -0,0 +1,68 @@
+import threading
+
+"""
+# In flight work accounting
+
+The stages don't poll their queues to find out they are done. Instead:
+
+- Every queue consumer stops when it dequeues the STOP sentinel.
+- Workers put the STOP sentinel on the result queue when they exit, so the writer knows when the last result arrived.
+- The indexer discovers its work while running, so it counts the scheduled but unfinished targets with a WorkTracker
+    and sends the sentinels the moment the count drops to zero.
+"""
+
+# Sentinel telling a queue consumer that no more items will follow.
+STOP = None
+
+
+class WorkTracker:
+    """
+    Thread safe counter of scheduled but unfinished tasks.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__finished = threading.Event()
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of tasks scheduled but not yet finished.
+        """
+        with self.__lock:
+            return self.__pending
+
+    def add(self, n: int = 1):
+        """
+        Registers n new tasks. Needs to be called before the task is put on a queue.
+
+        :param n: number of tasks
+        :return:
+        """
+        with self.__lock:
+            self.__pending += n
+
+    def done(self) -> bool:
+        """
+        Marks one task as finished. Tasks scheduled by a task need to be added before the task is marked as done.
+
+        :return: True for the call that finished the last pending task.
+        """
+        with self.__lock:
+            self.__pending -= 1
+
+            if self.__pending == 0:
+                self.__finished.set()
+                return True
+
+            return False
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Blocks until all tasks are finished.
+
+        :param timeout: seconds to wait at most, None to wait forever
+        :return: True if all tasks are finished
+        """
+        return self.__finished.wait(timeout)
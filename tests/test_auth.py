@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from requests.cookies import RequestsCookieJar  # noqa: E402
+
+from eth_loader.auth import LoginCache  # noqa: E402
+
+
+def test_unreachable_series_falls_back_to_the_general_login():
+    jar = RequestsCookieJar()
+
+    def login(key, username, password):
+        if key == "down":
+            raise ConnectionError("unreachable")
+        return jar
+
+    cache = LoginCache({"down": ("u", "p"), "up": ("u", "p")}, login=login, default="general")
+    cache.login_all(["down", "up"])
+
+    assert cache.cookies(("down",)) == "general"
+    assert cache.cookies(("up",)) is jar
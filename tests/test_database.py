@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from eth_loader.database import Database  # noqa: E402
+
+
+def test_failed_sites_are_children_of_their_parent(tmp_path):
+    db = Database(str(tmp_path / "sites.db"))
+    db.create_sites()
+
+    parent = "https://www.video.ethz.ch/lectures/d-infk.html"
+    child = "https://www.video.ethz.ch/lectures/d-infk/2023.html"
+    db.upsert_sites([(parent, 0, "etag", None)])
+    db.fail_sites([child])
+
+    assert (child, 0, None, None) in db.known_sites()
+    assert db.cur.execute("SELECT failed, parent = (SELECT key FROM sites WHERE URL = ?) FROM sites WHERE URL = ?",
+                          (parent, child)).fetchone() == (1, 1)
+
+    # loaded by a later run
+    db.upsert_sites([(child, 1, "etag", None)])
+    assert db.cur.execute("SELECT failed, IS_VIDEO FROM sites WHERE URL = ?", (child,)).fetchone() == (0, 1)
@@ -0,0 +1,38 @@
+import glob
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from eth_loader.extraction import extract_page, extract_page_tree  # noqa: E402
+
+SAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "sample text", "*.html")))
+
+EDGE_CASES = [
+    # more than one link per box, the xpath returns all of them
+    b'<html><body><div class="newsListBox"><a href="/a.html">a</a><a href="/b.html">b</a></div></body></html>',
+    # marker in a script and a comment only
+    b'<html><head><script>var x = "<vp-episode-page>";</script></head><body><!-- <vp-episode-page> -->'
+    b'<div class="newsListBox"><a href="/a.html">a</a></div></body></html>',
+    # tag name only starting like the marker
+    b'<html><body><vp-episode-pager></vp-episode-pager><div class="newsListBox"><a href="/a.html">a</a></div>'
+    b'</body></html>',
+    # box whose link is nested
+    b'<html><body><div class="newsListBox"><p><a href="/a.html">a</a></p></div></body></html>',
+    b'<html><body><vp-episode-page id="1"></vp-episode-page></body></html>',
+]
+
+
+@pytest.mark.parametrize("path", SAMPLES)
+def test_extract_page_matches_tree_on_samples(path):
+    with open(path, "rb") as f:
+        content = f.read()
+
+    assert extract_page(content) == extract_page_tree(content)
+
+
+@pytest.mark.parametrize("content", EDGE_CASES)
+def test_extract_page_matches_tree_on_edge_cases(content):
+    assert extract_page(content) == extract_page_tree(content)
@@ -0,0 +1,49 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from eth_loader.metadata_loader import EpisodeLoader  # noqa: E402
+from eth_loader.stream_loader import BetterStreamLoader  # noqa: E402
+
+
+def legacy_db(path: str):
+    """
+    Sites and metadata tables as written by the baseline indexer and metadata loader.
+    """
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE sites (key INTEGER PRIMARY KEY AUTOINCREMENT, parent INTEGER, URL TEXT UNIQUE , "
+                "IS_VIDEO INTEGER CHECK (IS_VIDEO >= 0 AND IS_VIDEO <= 1),found TEXT);")
+    con.execute("INSERT INTO sites (key, parent, URL, IS_VIDEO, found) "
+                "VALUES (0, -1, 'https://www.video.ethz.ch', 0, 'x')")
+    con.execute("INSERT INTO sites (parent, URL, IS_VIDEO, found) "
+                "VALUES (0, 'https://www.video.ethz.ch/lectures/d-infk/2023/autumn/252-0027-00L.html', 1, 'x')")
+    con.execute("CREATE TABLE metadata (key INTEGER PRIMARY KEY AUTOINCREMENT, parent INTEGER, URL TEXT , json TEXT,"
+                "deprecated INTEGER DEFAULT 0 CHECK (metadata.deprecated >= 0 AND metadata.deprecated <= 1),"
+                "found TEXT)")
+    con.execute("INSERT INTO metadata (parent, URL, json, found) VALUES (1, ?, ?, 'x')",
+                ("https://www.video.ethz.ch/lectures/d-infk/2023/autumn/252-0027-00L.series-metadata.json",
+                 '{"episodes": [{"id": "e1"}, {"id": "e2"}]}'))
+    con.commit()
+    con.close()
+
+
+def test_stream_loader_on_legacy_metadata(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    legacy_db(path)
+
+    loader = BetterStreamLoader(path)
+
+    assert [dl.episode_url.rsplit("/", 1)[1] for dl in loader.download_list] == \
+        ["e1.series-metadata.json", "e2.series-metadata.json"]
+
+
+def test_metadata_loader_on_legacy_sites(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    legacy_db(path)
+
+    loader = EpisodeLoader(path)
+
+    assert [site[1] for site in loader.urls] == \
+        ["https://www.video.ethz.ch/lectures/d-infk/2023/autumn/252-0027-00L.html"]
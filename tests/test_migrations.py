@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from eth_loader.database import Database  # noqa: E402
+
+
+def baseline_db(path: str):
+    """
+    Episodes and streams tables as written by the baseline stream loader, which stored the rows of the stream key
+    lookup ([[12], [3]]) in episodes.streams.
+    """
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE episodes (key INTEGER PRIMARY KEY AUTOINCREMENT, parent INTEGER, URL TEXT , json TEXT,"
+                "deprecated INTEGER DEFAULT 0 CHECK (episodes.deprecated >= 0 AND episodes.deprecated <= 1),"
+                "found TEXT,streams TEXT)")
+    con.execute("CREATE TABLE streams (key INTEGER PRIMARY KEY AUTOINCREMENT, URL TEXT , resolution TEXT,"
+                "deprecated INTEGER DEFAULT 0 CHECK (deprecated >= 0 AND deprecated <= 1),found TEXT)")
+    con.execute("INSERT INTO streams (key, URL, resolution, found) VALUES (-1, 'dummy', 'dummy', 'dummy')")
+
+    for key in (3, 12, 112):
+        con.execute("INSERT INTO streams (key, URL, resolution, found) VALUES (?, ?, '1920 x 1080', 'x')",
+                    (key, f"https://x/{key}.mp4"))
+
+    con.execute("INSERT INTO episodes (parent, URL, json, found, streams) VALUES (1, 'e1', '{}', 'x', '[[12], [3]]')")
+    con.execute("INSERT INTO episodes (parent, URL, json, found, streams, deprecated) "
+                "VALUES (1, 'e0', '{}', 'x', '[[112]]', 1)")
+    con.commit()
+    con.close()
+
+
+def test_baseline_episodes_migrate(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    baseline_db(path)
+
+    db = Database(path)
+    db.create_episodes()
+
+    assert db.cur.execute("SELECT streams FROM episodes ORDER BY key").fetchall() == [("[12, 3]",), ("[112]",)]
+    assert db.cur.execute("SELECT episode_key, stream_key FROM episode_streams ORDER BY stream_key").fetchall() \
+        == [(1, 3), (1, 12), (2, 112)]
+
+    # 112 is only referred to by a deprecated episode, -1 is the dummy
+    assert db.deprecate_streams() == 2
+    assert db.cur.execute("SELECT key FROM streams WHERE deprecated = 0 ORDER BY key").fetchall() == [(3,), (12,)]
+
+
+def test_backfill_nested_stream_keys(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    baseline_db(path)
+
+    db = Database(path)
+    db.cur.execute("CREATE TABLE episode_streams (episode_key INTEGER NOT NULL, stream_key INTEGER NOT NULL, "
+                   "PRIMARY KEY (episode_key, stream_key)) WITHOUT ROWID")
+    db.backfill_episode_streams()
+
+    assert db.cur.execute("SELECT COUNT(*) FROM episode_streams").fetchone() == (3,)